@@ -0,0 +1,311 @@
+from __future__ import print_function, division
+import sys, os, heapq, random, collections
+from array import array
+import seiscomp.core, seiscomp.client, seiscomp.datamodel, seiscomp.logging
+
+
+class LocalConnection(object):
+    """
+    In-process stand-in for the messaging connection. Sent messages
+    are queued and delivered by deliver(), without network and
+    serialization, so that the generator and the consumer code can be
+    benchmarked alone.
+    """
+
+    def __init__(self):
+        self._queue = collections.deque()
+
+    def send(self, msg):
+        self._queue.append(msg)
+        return True
+
+    def deliver(self, receive):
+        while self._queue:
+            nmsg = seiscomp.datamodel.NotifierMessage.Cast(self._queue.popleft())
+            for item in nmsg:
+                n = seiscomp.datamodel.Notifier.Cast(item)
+                if n:
+                    receive(n.object())
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """
+    Percentiles of a sequence of values and its maximum. Returns None
+    for an empty sequence.
+    """
+    if not len(values):
+        return None
+    values = sorted(values)
+    return [ values[min(int(p/100.*len(values)), len(values)-1)] for p in ps ] + [ values[-1] ]
+
+
+def formatLatencies(values):
+    p = percentiles(values)
+    if p is None:
+        return "no latencies"
+    return "latency p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  max %.1f ms" % tuple(1000*x for x in p)
+
+
+class Profile(object):
+    """
+    Generates the times of synthetic picks, in seconds since start,
+    together with the index of the picking station.
+
+    There is a Poisson background of uncorrelated picks at 'rate' per
+    second. On top of that, events make 'eventSize' random stations
+    pick within 'spread' seconds after the event:
+
+        constant    no events
+        burst       one event every 'interval' seconds
+        aftershock  event rate decaying with the modified Omori law
+                    K/(c+t)^p events per second
+    """
+
+    def __init__(self, name="constant", stations=100, rate=1., eventSize=50, spread=30.,
+                 interval=60., omoriK=10., omoriC=10., omoriP=1.1):
+        if name not in ("constant", "burst", "aftershock"):
+            raise ValueError("unknown profile '%s'" % name)
+        self.name = name
+        self.stations = stations
+        self.rate = rate
+        self.eventSize = min(eventSize, stations)
+        self.spread = spread
+        self.interval = interval
+        self.omoriK, self.omoriC, self.omoriP = omoriK, omoriC, omoriP
+
+    def _eventRate(self, t):
+        return self.omoriK / (self.omoriC + t)**self.omoriP
+
+    def _events(self):
+        if self.name == "burst":
+            t = 0.
+            while True:
+                yield t
+                t += self.interval
+        elif self.name == "aftershock":
+            # thinning of a Poisson process with the maximum rate,
+            # which is the rate at t=0
+            maxRate = self._eventRate(0.)
+            t = 0.
+            while True:
+                t += random.expovariate(maxRate)
+                if random.random() < self._eventRate(t) / maxRate:
+                    yield t
+
+    def __iter__(self):
+        # picks are yielded in time order; the picks of events can
+        # overlap with each other and with the background
+        pending = []
+        background = random.expovariate(self.rate) if self.rate > 0 else None
+        events = self._events() if self.name != "constant" else iter(())
+        nextEvent = next(events, None)
+        while True:
+            candidates = [ t for t in (background, nextEvent) if t is not None ]
+            if not candidates and not pending:
+                return
+            t = min(candidates) if candidates else None
+            if pending and (t is None or pending[0][0] <= t):
+                yield heapq.heappop(pending)
+                continue
+            if t == background:
+                yield t, random.randrange(self.stations)
+                background += random.expovariate(self.rate)
+            else:
+                for sta in random.sample(range(self.stations), self.eventSize):
+                    heapq.heappush(pending, (t + random.uniform(0, self.spread), sta))
+                nextEvent = next(events, None)
+
+
+class PickLoadGenerator(seiscomp.client.Application):
+    """
+    Sends synthetic picks and amplitudes at configurable rates and
+    measures the end-to-end latency, i.e. the time between setting the
+    creation time of a pick right before sending it and its reception
+    through the messaging subscription.
+    """
+
+    def __init__(self, argc, argv):
+        seiscomp.client.Application.__init__(self, argc, argv)
+        self.setMessagingEnabled(True)
+        self.setDatabaseEnabled(False, False)
+        self.setPrimaryMessagingGroup("PICK")
+        self.addMessagingSubscription("PICK")
+        self.addMessagingSubscription("AMPLITUDE")
+        # the picks are sent and received by the same process
+        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+        self._local = None
+        self._duration = None
+        self._statsInterval = 10.
+        self._network = "XX"
+        self._amplitudeTypes = [ "snr", "mb" ]
+
+    def createCommandLineDescription(self):
+        seiscomp.client.Application.createCommandLineDescription(self)
+        self.commandline().addGroup("Mode")
+        self.commandline().addOption("Mode", "local", "deliver the picks in-process instead of through the messaging")
+        self.commandline().addGroup("Load")
+        self.commandline().addStringOption("Load", "profile", "constant, burst or aftershock (default is constant)")
+        self.commandline().addStringOption("Load", "rate", "background pick rate per second (default is 1)")
+        self.commandline().addStringOption("Load", "stations", "number of stations (default is 100)")
+        self.commandline().addStringOption("Load", "network", "network code of the stations (default is XX)")
+        self.commandline().addStringOption("Load", "event-size", "number of stations picking an event (default is 50)")
+        self.commandline().addStringOption("Load", "spread", "time span in seconds over which the picks of an event arrive (default is 30)")
+        self.commandline().addStringOption("Load", "interval", "interval in seconds between events of the burst profile (default is 60)")
+        self.commandline().addStringOption("Load", "omori", "parameters K,c,p of the aftershock rate K/(c+t)^p (default is 10,10,1.1)")
+        self.commandline().addStringOption("Load", "amplitude-types", "comma-separated types of the amplitudes sent with each pick (default is snr,mb)")
+        self.commandline().addStringOption("Load", "duration", "stop after this many seconds (default is to run until stopped)")
+        self.commandline().addStringOption("Load", "stats-interval", "interval in seconds at which statistics are logged (default is 10)")
+
+    def _option(self, name, default, convert=str):
+        try:    return convert(self.commandline().optionString(name))
+        except: return default
+
+    def validateParameters(self):
+        if not seiscomp.client.Application.validateParameters(self):
+            return False
+        if self.commandline().hasOption("local"):
+            self.setMessagingEnabled(False)
+        return True
+
+    def init(self):
+        if not seiscomp.client.Application.init(self):
+            return False
+
+        omori = self._option("omori", [ 10., 10., 1.1 ], lambda s: [ float(x) for x in s.split(",") ])
+        try:
+            self._profile = Profile(self._option("profile", "constant"),
+                stations  = self._option("stations", 100, int),
+                rate      = self._option("rate", 1., float),
+                eventSize = self._option("event-size", 50, int),
+                spread    = self._option("spread", 30., float),
+                interval  = self._option("interval", 60., float),
+                omoriK=omori[0], omoriC=omori[1], omoriP=omori[2])
+        except (ValueError, IndexError) as e:
+            seiscomp.logging.error(str(e))
+            return False
+        self._network = self._option("network", self._network)
+        self._amplitudeTypes = self._option("amplitude-types", self._amplitudeTypes, lambda s: s.split(","))
+        self._duration = self._option("duration", None, float)
+        self._statsInterval = self._option("stats-interval", self._statsInterval, float)
+
+        if self.commandline().hasOption("local"):
+            self._local = LocalConnection()
+
+        # identifies the objects sent by this process
+        self._author = "pickload@%s:%d" % (os.uname()[1], os.getpid())
+        self._picks = iter(self._profile)
+        self._pending = next(self._picks, None)
+        self._sent = self._received = 0
+        self._finished = None
+        self._latencies = array("d")
+        self._intervalLatencies = array("d")
+        self._intervalStart = self._start = seiscomp.core.Time.GMT()
+        self._intervalCounts = (0, 0)
+        self.enableTimer(1)
+        return True
+
+    def _createPick(self, n, sta, now):
+        pick = seiscomp.datamodel.Pick.Create("Pick/%s/%d" % (self._author, n))
+        wfid = seiscomp.datamodel.WaveformStreamID()
+        wfid.setNetworkCode(self._network)
+        wfid.setStationCode("S%04d" % sta)
+        wfid.setLocationCode("")
+        wfid.setChannelCode("HHZ")
+        pick.setWaveformID(wfid)
+        # a typical picker delay
+        pick.setTime(seiscomp.datamodel.TimeQuantity(now - seiscomp.core.TimeSpan(2.)))
+        pick.setPhaseHint(seiscomp.datamodel.Phase("P"))
+        pick.setEvaluationMode(seiscomp.datamodel.AUTOMATIC)
+
+        amplitudes = []
+        for typ in self._amplitudeTypes:
+            ampl = seiscomp.datamodel.Amplitude.Create("Amplitude/%s/%d/%s" % (self._author, n, typ))
+            ampl.setType(typ)
+            ampl.setPickID(pick.publicID())
+            ampl.setWaveformID(wfid)
+            ampl.setAmplitude(seiscomp.datamodel.RealQuantity(random.lognormvariate(1., 1.)))
+            ampl.setPeriod(seiscomp.datamodel.RealQuantity(1.))
+            amplitudes.append(ampl)
+        return pick, amplitudes
+
+    def _send(self, n, sta):
+        # pick and amplitudes are sent in one message
+        # The creation time is set right before sending, so that the
+        # latency includes everything from here to the reception.
+        now = seiscomp.core.Time.GMT()
+        pick, amplitudes = self._createPick(n, sta, now)
+        crea = seiscomp.datamodel.CreationInfo()
+        crea.setAuthor(self._author)
+        crea.setAgencyID("TEST")
+        crea.setCreationTime(now)
+        ep = seiscomp.datamodel.EventParameters()
+        seiscomp.datamodel.Notifier.Enable()
+        for obj in [ pick ] + amplitudes:
+            obj.setCreationInfo(crea)
+            ep.add(obj)
+        msg = seiscomp.datamodel.Notifier.GetMessage()
+        seiscomp.datamodel.Notifier.Disable()
+        connection = self._local or self.connection()
+        if not connection.send(msg):
+            seiscomp.logging.error("failed to send %s" % pick.publicID())
+
+    def _receive(self, obj):
+        obj = seiscomp.datamodel.Pick.Cast(obj) or seiscomp.datamodel.Amplitude.Cast(obj)
+        if obj is None:
+            return
+        try:
+            crea = obj.creationInfo()
+        except ValueError:
+            return
+        if crea.author() != self._author:
+            return
+        if seiscomp.datamodel.Pick.Cast(obj):
+            self._received += 1
+            latency = float(seiscomp.core.Time.GMT() - crea.creationTime())
+            self._latencies.append(latency)
+            self._intervalLatencies.append(latency)
+
+    def addObject(self, parentID, obj):
+        self._receive(obj)
+
+    def _logStatistics(self, label, start, latencies, counts=(0, 0)):
+        dt = max(float(seiscomp.core.Time.GMT() - start), 1.e-6)
+        seiscomp.logging.info("%s: %d picks sent  %d received  %.1f picks/s  %s" % (
+            label, self._sent - counts[0], self._received - counts[1],
+            (self._sent - counts[0]) / dt, formatLatencies(latencies)))
+
+    def handleTimeout(self):
+        # send everything that is due, then deliver locally
+        elapsed = float(seiscomp.core.Time.GMT() - self._start)
+        if self._duration is not None:
+            elapsed = min(elapsed, self._duration)
+        while self._pending is not None and self._pending[0] <= elapsed:
+            self._sent += 1
+            self._send(self._sent, self._pending[1])
+            self._pending = next(self._picks, None)
+        if self._local:
+            self._local.deliver(self._receive)
+
+        if float(seiscomp.core.Time.GMT() - self._intervalStart) >= self._statsInterval:
+            self._logStatistics("interval", self._intervalStart, self._intervalLatencies, self._intervalCounts)
+            self._intervalStart = seiscomp.core.Time.GMT()
+            self._intervalLatencies = array("d")
+            self._intervalCounts = (self._sent, self._received)
+
+        # after the last pick, wait up to 10 s for the outstanding ones
+        if self._pending is None or (self._duration is not None and elapsed >= self._duration):
+            if self._finished is None:
+                self._finished = seiscomp.core.Time.GMT()
+            if self._received >= self._sent or \
+               float(seiscomp.core.Time.GMT() - self._finished) >= 10:
+                self.exit(0)
+
+    def done(self):
+        if self._sent:
+            self._logStatistics("total", self._start, self._latencies)
+        seiscomp.client.Application.done(self)
+
+
+if __name__ == "__main__":
+    app = PickLoadGenerator(len(sys.argv), sys.argv)
+    sys.exit(app())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Suppression of duplicate MiniSEED records in a time-sorted sequence
+
+A record is identified by a digest of its stream ID, start time and
+payload, i.e. the blockettes and the data. The sequence number and
+the data quality indicator are ignored, so that the same record from
+two archives is recognized even if these differ. As the input is
+sorted by time, only the digests of the records of the last 'window'
+seconds need to be remembered.
+"""
+
+import hashlib, collections
+
+
+def streamID(raw):
+    """
+    NET.STA.LOC.CHA of a raw MiniSEED record, given as bytes or
+    memoryview
+    """
+    fields = bytes(raw[8:20])
+    sta, loc, cha, net = fields[0:5], fields[5:7], fields[7:10], fields[10:12]
+    return ".".join(x.decode("ascii", "replace").strip() for x in (net, sta, loc, cha))
+
+
+def digest(raw):
+    # stream ID and start time (bytes 8-30) and everything after the
+    # fixed header (bytes 48 on)
+    h = hashlib.md5(raw[8:30])
+    h.update(raw[48:])
+    return h.digest()
+
+
+class DuplicateFilter(object):
+    """
+    Filters duplicates from a sequence of raw records sorted by time.
+    Call isDuplicate(t, raw) for each record in order, where t is the
+    sort key in seconds, e.g. the end time.
+
+    Memory is bounded by the number of records within 'window' seconds.
+    The number of dropped records per stream ID is counted in
+    'duplicates'.
+    """
+
+    def __init__(self, window=60.):
+        self.window = window
+        self._recent = collections.deque()
+        self._digests = set()
+        self.duplicates = collections.Counter()
+
+    def isDuplicate(self, t, raw):
+        while self._recent and self._recent[0][0] < t - self.window:
+            self._digests.discard(self._recent.popleft()[1])
+
+        key = digest(raw)
+        if key in self._digests:
+            self.duplicates[streamID(raw)] += 1
+            return True
+        self._recent.append( (t, key) )
+        self._digests.add(key)
+        return False
+
+    def total(self):
+        return sum(self.duplicates.values())
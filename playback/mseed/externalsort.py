@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+External merge sort of raw MiniSEED records
+
+Records are collected in memory together with their sort key, e.g.
+the end time in seconds. Whenever the buffered records exceed the
+memory budget, they are sorted and spilled to a temporary file as a
+"run". Finally all runs are merged, so that no more than the memory
+budget plus one buffered record per run is held in memory.
+
+Run file format: for each record a header of the sort key (double)
+and the record length (unsigned int), followed by the raw record.
+"""
+
+from __future__ import division
+import os, struct, heapq, tempfile, time
+
+_header = struct.Struct("<dI")
+
+
+def _readRun(f):
+    # yield (key, raw) from a run file
+    f.seek(0)
+    read = f.read
+    while True:
+        header = read(_header.size)
+        if len(header) < _header.size:
+            return
+        key, size = _header.unpack(header)
+        yield key, read(size)
+
+
+class ExternalSorter(object):
+    """
+    Sorts (key, raw) tuples within a bounded amount of memory. Add all
+    records with add(), then iterate over sorted() once.
+
+    memoryBudget is the approximate maximum number of bytes of raw
+    records held in memory, tmpDir the directory for the run files
+    (default is the system's temporary directory).
+    """
+
+    def __init__(self, memoryBudget=512*1024*1024, tmpDir=None, bufferSize=1024*1024):
+        self.memoryBudget = memoryBudget
+        self.tmpDir = tmpDir
+        self.bufferSize = bufferSize
+        self._buffer = []
+        self._bufferedBytes = 0
+        self._runs = []
+
+        # statistics
+        self.records = 0
+        self.spilledBytes = 0
+        self.startTime = time.time()
+
+    def add(self, key, raw):
+        self._buffer.append( (key, raw) )
+        self._bufferedBytes += len(raw)
+        self.records += 1
+        if self._bufferedBytes >= self.memoryBudget:
+            self._spill()
+
+    def _spill(self):
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        # The file is unlinked right away and removed on close. Each run
+        # gets its own large buffer for the merge.
+        fd, path = tempfile.mkstemp(prefix="mseed-run-", dir=self.tmpDir)
+        f = os.fdopen(fd, "w+b", self.bufferSize)
+        os.unlink(path)
+        for key, raw in self._buffer:
+            f.write(_header.pack(key, len(raw)))
+            f.write(raw)
+        f.flush()
+        self.spilledBytes += self._bufferedBytes
+        self._runs.append(f)
+        self._buffer = []
+        self._bufferedBytes = 0
+
+    def runs(self):
+        return len(self._runs)
+
+    def sorted(self):
+        """
+        Yield all records as (key, raw) in sorted order. If nothing was
+        spilled, the records are sorted in memory.
+        """
+        self._buffer.sort()
+        if not self._runs:
+            buf, self._buffer = self._buffer, []
+            for item in buf:
+                yield item
+            return
+
+        # the last run stays in memory
+        sources = [ _readRun(f) for f in self._runs ]
+        buf, self._buffer = self._buffer, []
+        sources.append(iter(buf))
+        try:
+            for item in heapq.merge(*sources):
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+
+    def rate(self):
+        dt = time.time() - self.startTime
+        return self.records / dt if dt > 0 else 0.
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
-import sys, time
-import seiscomp.client, seiscomp.datamodel
+import sys, time, threading, shutil
+import seiscomp.core, seiscomp.client, seiscomp.datamodel, seiscomp.io, seiscomp.logging
+import externalsort, duplicates, manifest, mseedheader
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 stream_whitelist = ["BH", "SH","HH"]
 component_whitelist = [] # set to ["Z"] for vertical component only
@@ -14,6 +20,23 @@ before, after = 1800, 1*3600+1800
 sort = True   # will produce sorted files with ".sorted-mseed" extension
 
 
+def rawRecord(rec):
+    raw = rec.raw().str()
+    if not isinstance(raw, bytes):
+        # SWIG returns std::string as str in Python 3
+        raw = raw.encode("utf-8", "surrogateescape")
+    return raw
+
+
+def seconds(t):
+    return t.seconds() + 1.e-6*t.microseconds()
+
+
+def toTime(x):
+    usecs = int(round(x*1.e6))
+    return seiscomp.core.Time(usecs // 1000000, usecs % 1000000)
+
+
 def filterStreams(streams):
     # NOTE that the criteria here are quite application dependent:
     # If we have HH and BH streams use only BH etc., but in other
@@ -81,11 +104,33 @@ class DumperApp(seiscomp.client.Application):
         self.setLoggingToStdErr(True)
         self.setDaemonEnabled(False)
         self.setRecordStreamEnabled(True)
+        self._memoryBudget = 512*1024*1024
+        self._tmpDir = None
+        self._connections = 4
+        self._workDir = None
+        self._streams = set()
+        self._streamsLock = threading.Lock()
 
 
     def validateParameters(self):
         if seiscomp.client.Application.validateParameters(self) == False:
             return False
+        try:
+            self._memoryBudget = int(self.commandline().optionString("memory-budget"))*1024*1024
+        except:
+            pass
+        try:
+            self._tmpDir = self.commandline().optionString("tmp-dir")
+        except:
+            pass
+        try:
+            self._workDir = self.commandline().optionString("work-dir")
+        except:
+            pass
+        try:
+            self._connections = max(int(self.commandline().optionString("connections")), 1)
+        except:
+            pass
         return True
 
 
@@ -94,9 +139,64 @@ class DumperApp(seiscomp.client.Application):
             self.commandline().addGroup("Dump")
             self.commandline().addStringOption("Dump", "event,E", "ID of event to dump")
             self.commandline().addOption("Dump", "unsorted,U", "produce unsorted output (not suitable for direct playback!)")
+            self.commandline().addStringOption("Dump", "memory-budget", "MB of records to sort in memory before spilling to disk (default is 512)")
+            self.commandline().addStringOption("Dump", "connections", "number of networks fetched concurrently (default is 4)")
+            self.commandline().addStringOption("Dump", "work-dir", "directory keeping the fetched records so that an interrupted run can be resumed")
+            self.commandline().addStringOption("Dump", "tmp-dir", "directory for the spilled records (default is the system's)")
         except:
             seiscomp.logging.warning("caught unexpected error %s" % sys.exc_info())
 
+    def fetch_group(self, netsta, requests, put):
+        """
+        Fetch the records of a group of streams with its own RecordStream
+        and pass each record to put() as tuple (group, start time, end
+        time, raw record). requests is a list of tuples (net, sta, loc,
+        cha, start time, end time).
+        """
+
+        # experts only:
+        # increase in case of connection problems, normally not needed
+        number_of_attempts = 1
+
+        for attempt in range(number_of_attempts):
+            if self.isExitRequested(): return
+
+            t0 = time.time()
+            stream = seiscomp.io.RecordStream.Open(self.recordStreamURL())
+            stream.setTimeout(3600)
+            for net, sta, loc, cha, t1, t2 in requests:
+                stream.addStream(net, sta, loc, cha, t1, t2)
+            # open streams are closed by the main thread on exit, which
+            # aborts a read waiting for data
+            with self._streamsLock:
+                self._streams.add(stream)
+
+            count = 0
+            input = seiscomp.io.RecordInput(stream, seiscomp.core.Array.INT, seiscomp.core.Record.SAVE_RAW)
+            try:
+                while not self.isExitRequested():
+                    try:
+                        rec = input.next()
+                    except:
+                        break
+                    if not rec:
+                        break
+
+                    count += 1
+                    put( (netsta, seconds(rec.startTime()), seconds(rec.endTime()), rawRecord(rec)) )
+            finally:
+                with self._streamsLock:
+                    self._streams.discard(stream)
+                stream.close()
+
+            seiscomp.logging.info("%s: read %d records for %d requests in %.1f s" % (
+                netsta, count, len(requests), time.time() - t0))
+            if count > 0 or attempt+1 == number_of_attempts:
+                break
+            if self.isExitRequested(): return
+            seiscomp.logging.info("%s: trying again" % netsta)
+            time.sleep(5)
+
     def get_and_write_data(self, t1, t2, out):
         dbr = seiscomp.datamodel.DatabaseReader(self.database())
         streams = getCurrentStreams(dbr)
@@ -104,65 +204,154 @@ class DumperApp(seiscomp.client.Application):
         # split all streams into groups of same net
         netsta_streams = {}
         for net, sta, loc, cha in streams:
+            if component_whitelist and cha[-1] not in component_whitelist:
+                continue
             netsta = net
             if not netsta in netsta_streams:
                 netsta_streams[netsta] = []
             netsta_streams[netsta].append( (net, sta, loc, cha) )
 
-        data = []
-        netsta_keys = netsta_streams.keys()
-        netsta_keys.sort()
-        for netsta in netsta_keys:
-
-            # experts only:
-            # increase in case of connection problems, normally not needed
-            number_of_attempts = 1
-
-            for attempt in range(number_of_attempts):
-                if self.isExitRequested(): return
-
-                stream = seiscomp.io.RecordStream.Open(self.recordStreamURL())
-                stream.setTimeout(3600)
-                for net, sta, loc, cha in netsta_streams[netsta]:
-                    if component_whitelist and cha[-1] not in component_whitelist:
-                        continue
-                    stream.addStream(net, sta, loc, cha, t1, t2)
-
-                count = 0
-                input = seiscomp.io.RecordInput(stream, seiscomp.core.Array.INT, seiscomp.core.Record.SAVE_RAW)
-                while 1:
+        # With a work directory, the records of each group are written
+        # to files there and only the spans missing according to the
+        # manifest are requested.
+        harvest = None
+        if self._workDir:
+            harvest = manifest.Manifest(self._workDir, seconds(t1), seconds(t2))
+
+        requests = {}
+        for netsta in sorted(netsta_streams.keys()):
+            requests[netsta] = []
+            for net, sta, loc, cha in netsta_streams[netsta]:
+                if harvest is None:
+                    requests[netsta].append( (net, sta, loc, cha, t1, t2) )
+                    continue
+                for start, end in harvest.missing(netsta, "%s.%s.%s.%s" % (net, sta, loc, cha)):
+                    requests[netsta].append( (net, sta, loc, cha, toTime(start), toTime(end)) )
+            if not requests[netsta]:
+                seiscomp.logging.info("%s: already fetched" % netsta)
+                del requests[netsta]
+
+        # The networks are fetched by a number of worker threads, each
+        # with its own RecordStream connection. The records are passed
+        # through a bounded queue to this thread, which sorts them by
+        # end time within the memory budget; sorted runs are spilled to
+        # disk and merged at the end.
+        sorter = externalsort.ExternalSorter(self._memoryBudget, self._tmpDir)
+        groups = queue.Queue()
+        for netsta in sorted(requests.keys()):
+            groups.put(netsta)
+        records = queue.Queue(10000)
+
+        def worker():
+            try:
+                while not self.isExitRequested():
                     try:
-                        rec = input.next()
-                    except:
+                        netsta = groups.get_nowait()
+                    except queue.Empty:
                         break
-                    if not rec:
-                        break
-
-                    count += 1
-                    if sort:
-                        data.append( (rec.endTime(), rec.raw().str()) )
-                    else:
-                        out.write("%s" % rec.raw().str())
-
-                sys.stderr.write("Read %d records for %d streams\n" % (count, len(netsta_streams[netsta])))
-                if count > 0 or attempt+1 == number_of_attempts:
-                    break
-                if self.isExitRequested(): return
-                sys.stderr.write("Trying again\n")
-                time.sleep(5)
-
-        if sort:
-            data.sort()
-
-        if sort:
+                    self.fetch_group(netsta, requests[netsta], records.put)
+                    # group complete
+                    records.put( (netsta, None, None, None) )
+            finally:
+                # tell the consumer that this worker is done
+                records.put(None)
+
+        workers = [ threading.Thread(target=worker, name="fetch-%d" % i)
+                    for i in range(min(self._connections, len(requests))) ]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        # open files of the groups being fetched and the spans covered
+        # by their records per stream
+        files, coverage = {}, {}
+
+        def commit(netsta):
+            f = files.pop(netsta)
+            f.close()
+            harvest.commit(netsta, f.name, coverage.pop(netsta))
+
+        active, count, t0 = len(workers), 0, time.time()
+        aborted = False
+        while active:
+            if self.isExitRequested() and not aborted:
+                # Stop the fetches in progress right away; what was
+                # fetched so far is kept in the work directory and the
+                # rest remains missing in the manifest.
+                with self._streamsLock:
+                    for stream in self._streams:
+                        stream.close()
+                aborted = True
+            try:
+                item = records.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                active -= 1
+                continue
+            netsta, start, end, raw = item
+            if harvest is not None:
+                if raw is None:
+                    if netsta in files:
+                        commit(netsta)
+                    continue
+                if netsta not in files:
+                    files[netsta] = open(harvest.newFile(netsta), "wb")
+                    coverage[netsta] = {}
+                files[netsta].write(raw)
+                coverage[netsta].setdefault(duplicates.streamID(raw), []).append( (start, end) )
+            elif raw is None:
+                continue
+            elif sort:
+                sorter.add(end, raw)
+            else:
+                out.write(raw)
+            count += 1
+
+        # keep what was fetched by interrupted groups
+        for netsta in list(files.keys()):
+            commit(netsta)
+        if self.isExitRequested(): return
+
+        dt = time.time() - t0
+        seiscomp.logging.info("fetched %d records  %.0f records/s" % (count, count/dt if dt > 0 else 0.))
+
+        if harvest is not None:
+            # everything fetched so far, including previous runs
+            t0 = time.time()
+            if sort:
+                dupes = duplicates.DuplicateFilter()
+                count = mseedheader.sortFiles(harvest.files(), out, dupes)
+            else:
+                for filename in harvest.files():
+                    with open(filename, "rb") as f:
+                        shutil.copyfileobj(f, out)
+
+            for netsta in sorted(netsta_streams.keys()):
+                for net, sta, loc, cha in netsta_streams[netsta]:
+                    streamID = "%s.%s.%s.%s" % (net, sta, loc, cha)
+                    for start, end in harvest.missing(netsta, streamID):
+                        seiscomp.logging.warning("%s: no data from %s to %s" % (
+                            streamID, toTime(start).iso(), toTime(end).iso()))
+        elif sort:
+            seiscomp.logging.info("%d runs spilled  %.1f MB" % (sorter.runs(), sorter.spilledBytes/1048576.))
             # finally write sorted data and ensure uniqueness
-            previous = None
-            for endTime, raw in data:
-                if previous is not None and raw[6:] == previous[6:]:
-                    # unfortunately duplicates do happen sometimes
+            # unfortunately duplicates do happen sometimes, e.g. from
+            # overlapping archives, and not necessarily adjacent
+            count, t0 = 0, time.time()
+            dupes = duplicates.DuplicateFilter()
+            for endTime, raw in sorter.sorted():
+                if dupes.isDuplicate(endTime, raw):
                     continue
-                out.write("%s" % raw)
-                previous = raw
+                out.write(raw)
+                count += 1
+
+        if sort:
+            dt = time.time() - t0
+            seiscomp.logging.info("wrote %d sorted records  %.0f records/s  %d duplicates dropped" % (
+                count, count/dt if dt > 0 else 0., dupes.total()))
+            for sid, n in sorted(dupes.duplicates.items()):
+                seiscomp.logging.info("%s: dropped %d duplicates" % (sid, n))
 
 
     def dump(self, eventID):
@@ -187,21 +376,23 @@ class DumperApp(seiscomp.client.Application):
             out = "%s-M%3.1f.sorted-mseed" % (eventID, val)
         else:
             out = "%s-M%3.1f.unsorted-mseed" % (eventID, val)
-        out = open(out, "w")
+        out = open(out, "wb")
 
         t0 = org.time().value()
         t1, t2 = t0 + seiscomp.core.TimeSpan(-before), t0 + seiscomp.core.TimeSpan(after)
 
         self.get_and_write_data(t1,t2,out)
+        out.close()
         return True
 
 
     def run(self):
+        global sort
         if self.commandline().hasOption("unsorted"):
             sort = False
 
         evid = self.commandline().optionString("event")
-        return self.dump(evid):
+        return self.dump(evid)
 
 
 def main():
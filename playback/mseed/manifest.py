@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Manifest of a resumable waveform harvest
+
+The records fetched for each stream group (network) are written to
+files in a work directory. The manifest in that directory lists these
+files and, per stream, the time spans covered by the records in them.
+A rerun then only needs to fetch the spans that are still missing.
+
+Times are seconds since 1970. The manifest is a JSON file, which is
+replaced atomically whenever a file is added, so that it never refers
+to an incomplete file.
+"""
+
+import os, json
+
+
+def mergeSpans(spans, tolerance=0.):
+    """
+    Merge a list of (start, end) spans into a sorted list of disjoint
+    spans. Spans separated by not more than tolerance are joined.
+    """
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + tolerance:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missingSpans(covered, start, end, tolerance=0.):
+    """
+    The parts of the span from start to end not covered by the sorted
+    disjoint spans in covered. Gaps of not more than tolerance are
+    ignored.
+    """
+    missing = []
+    t = start
+    for s, e in covered:
+        if e <= t:
+            continue
+        if s >= end:
+            break
+        if s > t + tolerance:
+            missing.append( (t, s) )
+        t = max(t, e)
+    if t < end - tolerance:
+        missing.append( (t, end) )
+    return missing
+
+
+class Manifest(object):
+    """
+    The manifest of the work directory for a harvest of the time window
+    from startTime to endTime. A manifest of a different time window
+    in the same directory is an error.
+
+    Gaps between records of not more than 'tolerance' seconds are not
+    considered missing data.
+    """
+
+    filename = "manifest.json"
+
+    def __init__(self, directory, startTime, endTime, tolerance=1.):
+        self.directory = directory
+        self.tolerance = tolerance
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, self.filename)
+        if os.path.exists(path):
+            with open(path) as f:
+                self._data = json.load(f)
+            if (self._data["start"], self._data["end"]) != (startTime, endTime):
+                raise ValueError("%s is for a different time window" % path)
+        else:
+            self._data = { "start": startTime, "end": endTime, "groups": {} }
+
+    def _group(self, name):
+        return self._data["groups"].setdefault(name, { "files": [], "coverage": {} })
+
+    def missing(self, name, streamID):
+        """
+        Spans of the time window still missing for a stream of a group
+        """
+        covered = self._group(name)["coverage"].get(streamID, [])
+        return missingSpans(covered, self._data["start"], self._data["end"], self.tolerance)
+
+    def newFile(self, name):
+        """
+        Path of the next file of a group. A file of that name left from
+        an interrupted run is not in the manifest and can be overwritten.
+        """
+        group = self._group(name)
+        return os.path.join(self.directory, "%s-%d.mseed" % (name, len(group["files"])))
+
+    def commit(self, name, path, coverage):
+        """
+        Add a complete file of a group, together with the spans covered
+        by its records as dict of stream ID to list of (start, end), and
+        save the manifest.
+        """
+        group = self._group(name)
+        group["files"].append(os.path.basename(path))
+        for streamID, spans in coverage.items():
+            spans = group["coverage"].get(streamID, []) + list(spans)
+            group["coverage"][streamID] = mergeSpans(spans, self.tolerance)
+        self.save()
+
+    def files(self):
+        return [ os.path.join(self.directory, filename)
+                 for name in sorted(self._data["groups"])
+                 for filename in self._data["groups"][name]["files"] ]
+
+    def save(self):
+        # write to a temporary file first, see above
+        path = os.path.join(self.directory, self.filename)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._data, f, indent=1, sort_keys=True)
+        os.rename(path + ".tmp", path)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reading of MiniSEED record headers without the SeisComP libraries
+
+Only the fixed header and the blockettes 100 and 1000 are parsed to
+get the stream ID, start and end time and length of each record. The
+files are memory-mapped and the records are never decoded or copied,
+they are only referenced by offset and length.
+"""
+
+from __future__ import division
+import mmap, struct, calendar, collections
+
+# fixed header from the start time (byte 20) to the first blockette
+# offset: year, day of year, hour, minute, second, unused, 1/10000 s,
+# number of samples, sample rate factor, sample rate multiplier,
+# activity flags, I/O flags, quality flags, number of blockettes, time
+# correction, data offset, first blockette
+_fixed = { ">": struct.Struct(">HHBBBxHHhhBBBBiHH"), "<": struct.Struct("<HHBBBxHHhhBBBBiHH") }
+_blockette = { ">": struct.Struct(">HH"), "<": struct.Struct("<HH") }
+_b100 = { ">": struct.Struct(">f"), "<": struct.Struct("<f") }
+
+Record = collections.namedtuple("Record", "streamID startTime endTime offset length")
+
+_yearStart = {}
+
+
+def _epoch(year, doy, hour, minute, second, fract):
+    try:
+        t = _yearStart[year]
+    except KeyError:
+        t = _yearStart[year] = calendar.timegm((year, 1, 1, 0, 0, 0))
+    return t + (doy-1)*86400 + hour*3600 + minute*60 + second + fract*1.e-4
+
+
+def _byteOrder(buf, offset):
+    # the byte order is the one giving a plausible year and day of year
+    for order in ">", "<":
+        year, doy = struct.unpack_from(order + "HH", buf, offset+20)
+        if 1900 <= year <= 2100 and 1 <= doy <= 366:
+            return order
+    raise ValueError("no MiniSEED record at offset %d" % offset)
+
+
+def _sampleRate(factor, multiplier):
+    if factor == 0 or multiplier == 0:
+        return 0.
+    if factor > 0:
+        return factor * multiplier if multiplier > 0 else -factor / multiplier
+    return -multiplier / factor if multiplier > 0 else 1. / (factor * multiplier)
+
+
+def readHeader(buf, offset=0):
+    """
+    Parse the header of the record at offset in buf, which can be any
+    object supporting the buffer protocol. Returns a Record.
+    """
+    view = memoryview(buf)
+    order = _byteOrder(view, offset)
+    year, doy, hour, minute, second, fract, nsamp, factor, multiplier, \
+        activity, io, quality, nblockettes, correction, dataOffset, next = \
+        _fixed[order].unpack_from(view, offset+20)
+
+    rate = _sampleRate(factor, multiplier)
+    length = None
+    # blockettes are chained by the offset of the next one
+    while next and nblockettes > 0:
+        typ, following = _blockette[order].unpack_from(view, offset+next)
+        if typ == 1000:
+            length = 1 << view[offset+next+6]
+        elif typ == 100:
+            rate = _b100[order].unpack_from(view, offset+next+4)[0]
+        next = following
+        nblockettes -= 1
+    if length is None:
+        raise ValueError("record at offset %d has no blockette 1000" % offset)
+
+    start = _epoch(year, doy, hour, minute, second, fract)
+    # time correction not applied yet
+    if not activity & 0x02:
+        start += correction*1.e-4
+    end = start + (nsamp / rate if rate > 0 else 0.)
+
+    fields = bytes(view[offset+8:offset+20])
+    sta, loc, cha, net = fields[0:5], fields[5:7], fields[7:10], fields[10:12]
+    streamID = ".".join(x.decode("ascii", "replace").strip() for x in (net, sta, loc, cha))
+    return Record(streamID, start, end, offset, length)
+
+
+def readRecords(buf):
+    """
+    Yield the Record of each MiniSEED record in buf
+    """
+    offset, size = 0, len(buf)
+    while offset + 48 <= size:
+        rec = readHeader(buf, offset)
+        if offset + rec.length > size:
+            raise ValueError("truncated record at offset %d" % offset)
+        yield rec
+        offset += rec.length
+
+
+def mapFile(filename):
+    """
+    Memory-map a file read-only. Returns None for an empty file, which
+    cannot be mapped.
+    """
+    with open(filename, "rb") as f:
+        f.seek(0, 2)
+        if f.tell() == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def sortFiles(filenames, out, dupes=None):
+    """
+    Write the records of the MiniSEED files to the binary file object
+    out sorted by end time. Only the index of the records is held in
+    memory; the records are copied directly from the mapped files.
+
+    If dupes is a duplicates.DuplicateFilter, duplicate records are
+    dropped. Returns the number of records written.
+    """
+    maps = []
+    index = []
+    for filename in filenames:
+        mm = mapFile(filename)
+        if mm is None:
+            continue
+        i = len(maps)
+        maps.append(mm)
+        for rec in readRecords(mm):
+            index.append( (rec.endTime, i, rec.offset, rec.length) )
+    index.sort()
+
+    count = 0
+    views = [ memoryview(mm) for mm in maps ]
+    for endTime, i, offset, length in index:
+        # no reference to the slices must survive the loop, otherwise
+        # the maps cannot be closed
+        if dupes is not None and dupes.isDuplicate(endTime, views[i][offset:offset+length]):
+            continue
+        out.write(views[i][offset:offset+length])
+        count += 1
+
+    del views
+    for mm in maps:
+        mm.close()
+    return count
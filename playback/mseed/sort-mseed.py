@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys, time, optparse
+import mseedheader, duplicates
+
+description="%prog - sort MiniSEED files by record end time for playback"
+
+p = optparse.OptionParser(usage="%prog [--keep-duplicates] files > sorted-mseed", description=description)
+p.add_option("-o", "--output", action="store", help="write to the specified file instead of stdout")
+p.add_option("-k", "--keep-duplicates", action="store_true", help="do not drop duplicate records")
+p.add_option("-v", "--verbose", action="store_true", help="run in verbose mode")
+
+(opt, filenames) = p.parse_args()
+
+if not filenames:
+    p.error("no input files")
+
+if opt.output:
+    out = open(opt.output, "wb")
+else:
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+
+dupes = None if opt.keep_duplicates else duplicates.DuplicateFilter()
+
+t0 = time.time()
+count = mseedheader.sortFiles(filenames, out, dupes)
+out.flush()
+if opt.output:
+    out.close()
+
+if opt.verbose:
+    dt = time.time() - t0
+    print("wrote %d sorted records  %.0f records/s" % (count, count/dt if dt > 0 else 0.), file=sys.stderr)
+    if dupes is not None:
+        print("dropped %d duplicates" % dupes.total(), file=sys.stderr)
+        for sid, n in sorted(dupes.duplicates.items()):
+            print("%s: dropped %d duplicates" % (sid, n), file=sys.stderr)
@@ -4,68 +4,21 @@
 from __future__ import print_function
 import sys, optparse
 import seiscomp.core
+import notifierlog
 
-description="%prog - extract notifiers from log based on start and end time"
+description="%prog - extract notifiers from log based on start and end time and/or objects"
 
-p = optparse.OptionParser(usage="%prog --start-time t2 --end-time t2  >", description=description)
+p = optparse.OptionParser(usage="%prog [--start-time t1] [--end-time t2] [--event id] [--class name] [--public-id id] files >", description=description)
 p.add_option("-s", "--start-time", action="store", help="specify start time")
 p.add_option("-e", "--end-time", action="store", help="specify end time")
+p.add_option("-E", "--event", action="store", help="extract only notifiers related to the specified event")
+p.add_option("-c", "--class", action="store", dest="class_name", help="extract only notifiers of objects of the specified class, e.g. Origin")
+p.add_option("-p", "--public-id", action="store", help="extract only notifiers related to the object with the specified public ID")
+p.add_option("-j", "--workers", action="store", type="int", help="number of threads decompressing the input files (default is one per CPU)")
 p.add_option("-v", "--verbose", action="store_true", help="run in verbose mode")
 
 (opt, filenames) = p.parse_args()
 
-class Item: pass
-
-def read_notifiers(filename, startTime, endTime):
-    if filename.endswith(".gz"):
-        import gzip
-        f = gzip.open(filename)
-    else:
-        f = open(filename)
-
-    while True:
-        while True:
-            line = f.readline()
-            if not line:
-                # empty input / EOF
-                return
-            line = line.strip()
-            if not line:
-                # blank line
-                continue
-            if line[0] == "#":
-                break
-
-        if len(line.split()) == 3:
-            sharp, timestamp, nbytes = line.split()
-        elif len(line.split()) == 4:
-            sharp, timestamp, nbytes, sbytes = line.split()
-            assert sbytes == "bytes"
-        elif len(line.split()) == 5:
-            sharp, timestamp, md5hash, nbytes, sbytes = line.split()
-            assert sbytes == "bytes"
-        else:
-            return
-
-        assert sharp[0] == "#"
-        time = seiscomp.core.Time.GMT()
-        time.fromString(timestamp, "%FT%T.%fZ")
-        if startTime is not None and time < startTime:
-            continue
-        if endTime is not None and time > endTime:
-            break
-
-        nbytes = int(nbytes)
-        assert sharp[0] == "#"
-        xml = f.read(nbytes)
-
-        item = Item()
-        item.time = time
-        item.line = line
-        item.xml = xml
-
-        yield item
-
 def parseTime(s):
     for fmtstr in "%FT%TZ", "%FT%T.%fZ":
         t = seiscomp.core.Time.GMT()
@@ -73,12 +26,30 @@ def parseTime(s):
             return t
     raise ValueError("could not parse time string '%s'" %s)
 
-startTime = parseTime(opt.start_time)
-endTime   = parseTime(opt.end_time)
+startTime = endTime = None
+if opt.start_time:
+    startTime = notifierlog.formatTime(parseTime(opt.start_time))
+if opt.end_time:
+    endTime   = notifierlog.formatTime(parseTime(opt.end_time))
+
+select = None
+if opt.event or opt.class_name or opt.public_id:
+    # select the entries using the object indexes only
+    def select(filename):
+        lines = notifierlog.loadObjectIndex(filename)
+        return notifierlog.selectObjects(lines, opt.event, opt.class_name, opt.public_id, startTime, endTime)
 
-for filename in filenames:
-    if opt.verbose:
+out = getattr(sys.stdout, "buffer", sys.stdout)
+
+if opt.verbose:
+    for filename in filenames:
         print("working on input file '%s'" % filename, file=sys.stderr)
-    for item in read_notifiers(filename, startTime, endTime):
-        print(item.line)
-        print(item.xml)
+
+# entries of all files are merged into one time-ordered sequence
+entries = notifierlog.mergeEntries(filenames, startTime, endTime, opt.workers, select=select)
+for item in entries:
+    out.write(item.line.encode() + b"\n")
+    out.write(item.xml + b"\n")
+
+if opt.verbose:
+    print("dropped %d duplicates" % entries.duplicates, file=sys.stderr)
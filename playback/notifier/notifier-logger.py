@@ -1,10 +1,20 @@
 from __future__ import print_function
-import sys, os, errno, gc, hashlib, logging, logging.handlers
-import seiscomp.client, seiscomp.datamodel, seiscomp.io, seiscomp.logging
+import sys, os, errno, gc, time, hashlib, threading
+import seiscomp.core, seiscomp.client, seiscomp.datamodel, seiscomp.io, seiscomp.logging
 from io import BytesIO
+import notifierlog
 
-def objectToXML(obj, expName = "trunk"):
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class XMLSerializer(object):
     # based on code contributed by Stephan Herrnkind
+    #
+    # The exporter, sink and buffer are created once and reused for
+    # all objects.
 
     class Sink(seiscomp.io.ExportSink):
 
@@ -18,37 +28,175 @@ def objectToXML(obj, expName = "trunk"):
             self.written += size
             return size
 
-    if not obj:
-        seiscomp.logging.error("could not serialize NULL object")
-        return None
+    def __init__(self, expName = "trunk"):
+        self._exp = seiscomp.io.Exporter.Create(expName)
+        if not self._exp:
+            raise ValueError("exporter '%s' not found" % expName)
+        self._exp.setFormattedOutput(True)
+        self._buf = BytesIO()
+        self._sink = self.Sink(self._buf)
+
+    def serialize(self, obj):
+        if not obj:
+            seiscomp.logging.error("could not serialize NULL object")
+            return None
+
+        self._buf.seek(0)
+        self._buf.truncate()
+        try:
+            self._exp.write(self._sink, obj)
+            return self._buf.getvalue().strip()
+        except Exception as err:
+            seiscomp.logging.error(str(err))
 
-    exp = seiscomp.io.Exporter.Create(expName)
-    if not exp:
-        seiscomp.logging.error("exporter '%s' not found" % expName)
         return None
-    exp.setFormattedOutput(True)
 
+
+def objectToXML(obj, expName = "trunk"):
     try:
-        io = BytesIO()
-        sink = Sink(io)
-        exp.write(sink, obj)
-        return io.getvalue().strip()
-    except Exception as err:
+        return XMLSerializer(expName).serialize(obj)
+    except ValueError as err:
         seiscomp.logging.error(str(err))
-
     return None
 
 
-class MyLogHandler(logging.handlers.TimedRotatingFileHandler):
+def notifierObjects(nmsg):
+    """
+    Return the (operation, className, objectID, parentID) tuples of the
+    notifiers in a NotifierMessage for the object index. For object
+    references the objectID is the ID of the referenced object.
+    """
+    objects = []
+    for item in nmsg:
+        n = seiscomp.datamodel.Notifier.Cast(item)
+        if n is None:
+            continue
+        obj = n.object()
+        objectID = None
+        po = seiscomp.datamodel.PublicObject.Cast(obj)
+        if po:
+            objectID = po.publicID()
+        else:
+            ref = seiscomp.datamodel.OriginReference.Cast(obj)
+            if ref:
+                objectID = ref.originID()
+            ref = seiscomp.datamodel.FocalMechanismReference.Cast(obj)
+            if ref:
+                objectID = ref.focalMechanismID()
+        objects.append((seiscomp.datamodel.EOperationNames.name(n.operation()),
+                        obj.className(), objectID, n.parentID()))
+    return objects
+
+
+class WriterThread(threading.Thread):
+    """
+    Writes the serialized notifier messages passed through a bounded
+    queue to the notifier log. Messages are written in batches and
+    the log is synced to disk every syncInterval seconds.
+
+    If the queue is full, put() either blocks until there is room
+    (backpressure) or, if dropWhenFull is set, drops the message.
+    Both events are counted.
+
+    If writing fails, e.g. because the disk is full, the thread ends
+    and the error is kept in 'error'. From then on put() and stop()
+    no longer wait for the thread and all messages are dropped.
+    """
+
+    def __init__(self, writer, queueSize=10000, syncInterval=10., dropWhenFull=False):
+        threading.Thread.__init__(self, name="writer")
+        self.daemon = True
+        self._writer = writer
+        self._queue = queue.Queue(queueSize)
+        self._syncInterval = syncInterval
+        self._dropWhenFull = dropWhenFull
+        self._lastSync = time.time()
+        self.error = None
+
+        # counters
+        self.received = 0
+        self.written = 0
+        self.bytesReceived = 0
+        self.drops = 0
+        self.backpressure = 0
+        self.maxDepth = 0
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def put(self, timestamp, xml, objects):
+        self.received += 1
+        self.bytesReceived += len(xml)
+        item = (timestamp, xml, objects)
+        if self.error is not None:
+            self.drops += 1
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self._dropWhenFull or not self._wait(item):
+                self.drops += 1
+                return
+            self.backpressure += 1
+        self.maxDepth = max(self.maxDepth, self._queue.qsize())
+
+    def _wait(self, item):
+        # put item into the queue as soon as there is room, unless the
+        # thread failed in the meantime
+        while self.error is None:
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        if self.error is None:
+            self._wait(None)
+        self.join()
+
+    def _write(self, item):
+        timestamp, xml, objects = item
+        header = "####  %s  %s  %d bytes" % (timestamp, hashlib.md5(xml).hexdigest(), len(xml))
+        self._writer.add(timestamp, header, xml, objects)
+        self.written += 1
+
+    def run(self):
+        try:
+            self._run()
+        except (IOError, OSError) as e:
+            seiscomp.logging.error("writing the notifier log failed: %s" % str(e))
+            self.error = e
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = False
+
+            # write everything that is queued in one go
+            batch = [item]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
 
-    def __init__(self, filename, **kwargs):
-        logging.handlers.TimedRotatingFileHandler.__init__(self, filename, **kwargs)
-        self.suffix = "%Y-%m-%dT%H:%M:%SZ"
-        self.utc = True
+            for item in batch:
+                if item is None:
+                    self._writer.flush(sync=True)
+                    return
+                if item:
+                    self._write(item)
 
-    def doRollover(self):
-        logging.handlers.TimedRotatingFileHandler.doRollover(self)
-        os.system("gzip '" + self.baseFilename + "'.*-*-*T*:*:*Z &")
+            now = time.time()
+            if now - self._lastSync >= self._syncInterval:
+                self._writer.flush(sync=True)
+                self._lastSync = now
+            else:
+                self._writer.flushIfDue()
 
 
 class NotifierLogger(seiscomp.client.Application):
@@ -66,13 +214,19 @@ class NotifierLogger(seiscomp.client.Application):
         # do nothing with the notifiers except logging
         self.setAutoApplyNotifierEnabled(False)
         self.setInterpretNotifierEnabled(False)
-        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False) 
-        self._logger = logging.getLogger("Rotating Log")
-        self._logger.setLevel(logging.INFO)
+        seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+        self._writer = None
+        self._thread = None
+        self._serializer = None
 
     def createCommandLineDescription(self):
         self.commandline().addGroup("Output")
         self.commandline().addStringOption("Output", "prefix", "path/file prefix to generate output file names")
+        self.commandline().addStringOption("Output", "block-size", "uncompressed size of the compressed blocks in kB (default is 256)")
+        self.commandline().addStringOption("Output", "sync-interval", "interval in seconds at which the log is synced to disk (default is 10)")
+        self.commandline().addStringOption("Output", "queue-size", "maximum number of messages waiting to be written (default is 10000)")
+        self.commandline().addOption("Output", "drop-when-full", "drop messages if the queue is full instead of waiting")
+        self.commandline().addStringOption("Output", "stats-interval", "interval in seconds at which statistics are logged (default is 60)")
         return True
 
     def validateParameters(self):
@@ -82,23 +236,85 @@ class NotifierLogger(seiscomp.client.Application):
             self._prefix = self.commandline().optionString("prefix")
         except:
             self._prefix = "notifier-log"
-        handler = MyLogHandler(self._prefix, when="h", interval=1, backupCount=48)
-        self._logger.addHandler(handler)
+        try:
+            self._blockSize = int(self.commandline().optionString("block-size"))*1024
+        except:
+            self._blockSize = 256*1024
+        try:
+            self._syncInterval = float(self.commandline().optionString("sync-interval"))
+        except:
+            self._syncInterval = 10.
+        try:
+            self._queueSize = int(self.commandline().optionString("queue-size"))
+        except:
+            self._queueSize = 10000
+        try:
+            self._statsInterval = float(self.commandline().optionString("stats-interval"))
+        except:
+            self._statsInterval = 60.
+        self._dropWhenFull = self.commandline().hasOption("drop-when-full")
+        return True
+
+    def init(self):
+        if not seiscomp.client.Application.init(self):
+            return False
+        # The segments are only opened when written, so check the
+        # output directory now.
+        directory = os.path.dirname(self._prefix) or "."
+        if not os.path.isdir(directory) or not os.access(directory, os.W_OK | os.X_OK):
+            seiscomp.logging.error("cannot write to directory '%s'" % directory)
+            return False
+        self._serializer = XMLSerializer()
+        self._writer = notifierlog.SegmentWriter(self._prefix, self._blockSize, self._syncInterval)
+        self._thread = WriterThread(self._writer, self._queueSize, self._syncInterval, self._dropWhenFull)
+        self._thread.start()
+        self._statsTime = time.time()
+        self._statsCounts = (0, 0, 0)
+        # garbage collection and statistics once per second rather
+        # than per message
+        self.enableTimer(1)
         return True
 
-    def _writeNotifier(self, xml):
-        now = seiscomp.core.Time.GMT().toString("%Y-%m-%dT%H:%M:%S.%f000000")[:26]+"Z"
-#       self._logger.info("####  %s  %s  %d bytes" % (now, hashlib.md5(xml).encode('utf-8').hexdigest(), len(xml)))
-        self._logger.info("####  %s  %s  %d bytes" % (now, hashlib.md5(xml).hexdigest(), len(xml)))
-        self._logger.info(xml)
+    def done(self):
+        if self._thread:
+            self._thread.stop()
+            if self._thread.error is None:
+                self._writer.close()
+            self._logStatistics()
+        seiscomp.client.Application.done(self)
+
+    def _logStatistics(self):
+        now = time.time()
+        t = self._thread
+        bytesReceived, written, bytesWritten = self._statsCounts
+        dt = max(now - self._statsTime, 1.e-6)
+        seiscomp.logging.info(
+            "queue depth %d (max %d)  received %d  written %d  drops %d  backpressure %d  "
+            "%.1f messages/s  %.0f bytes/s in  %.0f bytes/s out" % (
+            t.depth(), t.maxDepth, t.received, t.written, t.drops, t.backpressure,
+            (t.written - written)/dt, (t.bytesReceived - bytesReceived)/dt,
+            (self._writer.bytesWritten - bytesWritten)/dt))
+        self._statsTime = now
+        self._statsCounts = (t.bytesReceived, t.written, self._writer.bytesWritten)
+        t.maxDepth = t.depth()
+
+    def handleTimeout(self):
+        if self._thread.error is not None:
+            # messages can no longer be logged
+            self.exit(1)
+            return
         gc.collect()
+        if time.time() - self._statsTime >= self._statsInterval:
+            self._logStatistics()
 
     def handleMessage(self, msg):
         nmsg = seiscomp.datamodel.NotifierMessage.Cast(msg)
         if nmsg:
-            xml = objectToXML(nmsg)
+            # time of reception
+            now = notifierlog.formatTime(seiscomp.core.Time.GMT())
+            xml = self._serializer.serialize(nmsg)
             if xml:
-                self._writeNotifier(xml)
+                self._thread.put(now, xml, notifierObjects(nmsg))
 #       seiscomp.client.Application.handleMessage(self, msg)
 
 
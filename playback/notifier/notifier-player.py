@@ -1,5 +1,51 @@
-import sys, os
+import sys, os, collections, resource
+from multiprocessing.pool import ThreadPool
 import seiscomp.core, seiscomp.client, seiscomp.datamodel, seiscomp.io, seiscomp.logging, seiscomp.utils
+import sc3stuff.scheduler, sc3stuff.util
+import notifierlog, notifierstate
+from sc3stuff.scheduler import monotonic
+
+
+def _disableRegistration():
+    # Runs in each parser thread. The registration flag is thread
+    # specific, so objects parsed in this thread are not entered into
+    # the global PublicObject registry, which is not thread safe.
+    seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+
+
+def _registerObjects(obj):
+    """
+    Register a public object parsed in a parser thread and its public
+    children, so that later notifiers can refer to them.
+    """
+    po = seiscomp.datamodel.PublicObject.Cast(obj)
+    if po is None:
+        return
+    po.registerMe()
+    org = seiscomp.datamodel.Origin.Cast(po)
+    if org:
+        for i in range(org.magnitudeCount()):
+            org.magnitude(i).registerMe()
+        for i in range(org.stationMagnitudeCount()):
+            org.stationMagnitude(i).registerMe()
+    fm = seiscomp.datamodel.FocalMechanism.Cast(po)
+    if fm:
+        for i in range(fm.momentTensorCount()):
+            fm.momentTensor(i).registerMe()
+
+
+def residentMemory():
+    """
+    Resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # not Linux; fall back to the peak resident memory
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
 
 class NotifierPlayer(seiscomp.client.Application):
 
@@ -11,16 +57,36 @@ class NotifierPlayer(seiscomp.client.Application):
         self._startTime = self._endTime = None
         self.xmlInputFileName = None
         self._time = None
-#       self.speed = 1
+        self.speed = 1
+        self._statsInterval = 60.
+        self._parseWorkers = 0
+        self._prefetch = 100
+        # wall time spent parsing (summed over the parser threads),
+        # waiting for parsed messages and applying them
+        self._parseTime = self._waitTime = self._applyTime = 0.
+        self._ep = None
+        self._snapshotDir = None
+        # With a horizon, objects not touched by any notifier for this
+        # many seconds and not referenced by an open event are evicted.
+        self._horizon = None
+        self._evictInterval = 60.
+        self._eviction = None
+        self._lastEviction = None
 
     def createCommandLineDescription(self):
         super(NotifierPlayer, self).createCommandLineDescription()
         self.commandline().addGroup("Play")
         self.commandline().addStringOption("Play", "begin", "specify start of time window")
         self.commandline().addStringOption("Play", "end", "specify end of time window")
-#       self.commandline().addStringOption("Play", "speed", "specify speed factor")
+        self.commandline().addStringOption("Play", "speed", "specify speed factor (0 means as fast as possible)")
+        self.commandline().addStringOption("Play", "stats-interval", "interval in seconds at which playback statistics are logged (default is 60)")
+        self.commandline().addStringOption("Play", "parse-workers", "number of threads parsing messages ahead of playback (default is 0, i.e. parse when needed)")
+        self.commandline().addStringOption("Play", "prefetch", "maximum number of messages parsed ahead (default is 100)")
+        self.commandline().addStringOption("Play", "horizon", "evict objects not updated for this many seconds and not referenced by an open event (default is to keep all objects)")
         self.commandline().addGroup("Input")
-        self.commandline().addStringOption("Input", "xml-file", "specify xml file")
+        self.commandline().addStringOption("Input", "xml-file", "specify notifier log file(s), separated by commas")
+        self.commandline().addStringOption("Input", "snapshot-dir", "specify directory of snapshots (default is the directory of the first log file)")
+        self.commandline().addOption("Input", "no-snapshot", "don't start from a snapshot")
 
     def init(self):
         if not super(NotifierPlayer, self).init():
@@ -35,13 +101,29 @@ class NotifierPlayer(seiscomp.client.Application):
         try:    self.xmlInputFileName = self.commandline().optionString("xml-file")
         except: pass
 
-#       try:
-#           self.speed = self.commandline().optionString("speed")
-#           if self.speed == "0":
-#               self.speed = None
-#           else:
-#               self.speed = float(self.speed)
-#       except: self.speed = 1
+        try:
+            self.speed = self.commandline().optionString("speed")
+            if self.speed == "0":
+                self.speed = None
+            else:
+                self.speed = float(self.speed)
+        except: self.speed = 1
+
+        try:    self._statsInterval = float(self.commandline().optionString("stats-interval"))
+        except: pass
+
+        try:    self._parseWorkers = int(self.commandline().optionString("parse-workers"))
+        except: pass
+
+        try:    self._prefetch = max(int(self.commandline().optionString("prefetch")), 1)
+        except: pass
+
+        try:    self._snapshotDir = self.commandline().optionString("snapshot-dir")
+        except: pass
+
+        try:    self._horizon = float(self.commandline().optionString("horizon"))
+        except: pass
+        self._eviction = notifierstate.Eviction(self._horizon)
 
         if start:
             self._startTime = seiscomp.core.Time.GMT()
@@ -49,78 +131,173 @@ class NotifierPlayer(seiscomp.client.Application):
                 seiscomp.logging.error("Wrong 'begin' format")
                 return False
         if end:
-            self._endTime = Core.Time.GMT()
+            self._endTime = seiscomp.core.Time.GMT()
             if self._endTime.fromString(end, "%FT%TZ") == False:
                 seiscomp.logging.error("Wrong 'end' format")
                 return False
         return True
 
     def _readNotifierMessageFromXML(self, xml):
-        b = seiscomp.utils.stringToStreambuf(xml)
-        ar = seiscomp.io.XMLArchive(b)
-        obj = ar.readObject()
-        if obj is None:
-            raise TypeError("got invalid xml")
-        nmsg = seiscomp.datamodel.NotifierMessage.Cast(obj)
-        if nmsg is None:
-            raise TypeError(self.xmlInputFile + ": no NotifierMessage object found")
-        return nmsg
+        return notifierstate.readNotifierMessage(xml)
+
+    def _loadSnapshot(self, filenames, startTime):
+        """
+        Load the latest snapshot before startTime and pass its objects
+        to addObject(). Returns the time of the snapshot or None.
+        """
+        snapshotDir = self._snapshotDir or os.path.dirname(filenames[0]) or "."
+        self._ep, snapshotTime = notifierstate.loadState(snapshotDir, startTime)
+        if snapshotTime is None:
+            seiscomp.logging.debug("no snapshot found in %s" % snapshotDir)
+            return
+        seiscomp.logging.info("starting from snapshot at %s" % snapshotTime)
+        ep = self._ep
+        t = notifierlog.seconds(snapshotTime)
+        for iterator in [ sc3stuff.util.EventParametersPicks, sc3stuff.util.EventParametersAmplitudes,
+                          sc3stuff.util.EventParametersOrigins, sc3stuff.util.EventParametersFocalMechanisms,
+                          sc3stuff.util.EventParametersEvents ]:
+            for obj in iterator(ep):
+                self._eviction.seen(obj.publicID(), t)
+                self.addObject(ep.publicID(), obj)
+        return snapshotTime
+
+    def _logMemory(self):
+        seiscomp.logging.info("memory: %d public objects  %.1f MB resident  %d objects evicted" % (
+            seiscomp.datamodel.PublicObject.ObjectCount(), residentMemory()/1048576., self._eviction.evicted))
+
+    def evictObject(self, obj):
+        # Called for each object evicted from memory. A player keeping
+        # references to objects must release them here.
+        seiscomp.logging.debug("evictObject class=%s publicID=%s" % (obj.className(), obj.publicID()))
+
+    def _parse(self, xml):
+        t0 = monotonic()
+        nmsg = self._readNotifierMessageFromXML(xml)
+        return nmsg, monotonic() - t0
+
+    def _parsedMessages(self, entries):
+        """
+        Yield (entry, NotifierMessage) in the order of the entries.
+        With parser threads, up to self._prefetch messages are parsed
+        ahead while the current one is applied.
+        """
+        if not self._parseWorkers:
+            for entry in entries:
+                nmsg, dt = self._parse(entry.xml.strip())
+                self._parseTime += dt
+                yield entry, nmsg
+            return
+
+        pool = ThreadPool(self._parseWorkers, _disableRegistration)
+        pending = collections.deque()
+
+        def nextParsed():
+            entry, result = pending.popleft()
+            t0 = monotonic()
+            nmsg, dt = result.get()
+            self._waitTime += monotonic() - t0
+            self._parseTime += dt
+            for item in nmsg:
+                n = seiscomp.datamodel.Notifier.Cast(item)
+                if n and n.operation() == seiscomp.datamodel.OP_ADD:
+                    _registerObjects(n.object())
+            return entry, nmsg
+
+        try:
+            for entry in entries:
+                pending.append((entry, pool.apply_async(self._parse, (entry.xml.strip(),))))
+                if len(pending) >= self._prefetch:
+                    yield nextParsed()
+            while pending:
+                yield nextParsed()
+        finally:
+            pool.terminate()
+
+    def _logTimes(self, wallTime):
+        seiscomp.logging.info(
+            "wall time %.1f s  parsing %.1f s  waiting for parser %.1f s  applying %.1f s" % (
+            wallTime, self._parseTime, self._waitTime, self._applyTime))
 
     def run(self):
         if not self.xmlInputFileName:
             return False
 
-        seiscomp.logging.debug("input file is %s" % self.xmlInputFileName)
-        f = open(self.xmlInputFileName)
-
-        while True:
-            while True:
-                line = f.readline()
-                if not line:
-                    # empty input
-                    return True
-                line = line.strip()
-                if not line:
-                    # blank line
-                    continue
-                if line[0] == "#":
-                    break
-
-            if len(line.split()) == 3:
-                sharp, timestamp, nbytes = line.split()
-            elif len(line.split()) == 4:
-                sharp, timestamp, nbytes, sbytes = line.split()
-                assert sbytes == "bytes"
-            elif len(line.split()) == 5:
-                sharp, timestamp, md5hash, nbytes, sbytes = line.split()
-                assert sbytes == "bytes"
-            else:
+        # several input files are merged into one time-ordered sequence
+        filenames = self.xmlInputFileName.split(",")
+        seiscomp.logging.debug("input files are %s" % " ".join(filenames))
+
+        startTime = endTime = None
+        if self._startTime is not None:
+            startTime = notifierlog.formatTime(self._startTime)
+        if self._endTime is not None:
+            endTime = notifierlog.formatTime(self._endTime)
+
+        # The state at the start of the time window is built up from the
+        # latest earlier snapshot plus the notifiers logged since, which
+        # are applied without pacing. Without snapshot, only the
+        # notifiers within the time window are played back.
+        snapshotTime = None
+        if startTime is not None and not self.commandline().hasOption("no-snapshot"):
+            snapshotTime = self._loadSnapshot(filenames, startTime)
+            # the notifiers between the snapshot and the start of the
+            # logs would be missing from the state
+            first = notifierlog.logStart(filenames)
+            if snapshotTime is not None and (first is None or first > snapshotTime):
+                seiscomp.logging.error("the logs start at %s, after the snapshot at %s; "
+                    "give earlier logs or use --no-snapshot" % (first, snapshotTime))
                 return False
-            assert sharp[0] == "#"
-            time = seiscomp.core.Time.GMT()
-            time.fromString(timestamp, "%FT%T.%fZ")
+        else:
+            self._ep = seiscomp.datamodel.EventParameters()
 
-            if self._startTime is not None and time < self._startTime:
-                continue
-            if self._endTime is not None and time > self._endTime:
+        # paces the notifier messages according to their reception
+        # times and the speed factor
+        scheduler = sc3stuff.scheduler.Scheduler(self.speed)
+
+        entries = notifierlog.mergeEntries(filenames, snapshotTime or startTime, endTime)
+        for entry, nmsg in self._parsedMessages(entries):
+            if self.isExitRequested():
                 break
 
-            nbytes = int(nbytes)
-            assert sharp[0] == "#"
-            xml = f.read(nbytes)
+            if snapshotTime is not None and entry.time <= snapshotTime:
+                # already contained in the snapshot
+                continue
+
+            time = seiscomp.core.Time.GMT()
+            time.fromString(entry.time, "%FT%T.%fZ")
 
-            nmsg = self._readNotifierMessageFromXML(xml.strip())
+            if startTime is None or entry.time >= startTime:
+                scheduler.wait(notifierlog.seconds(entry.time))
             self.sync(time)
 
+            t = notifierlog.seconds(entry.time)
+            t0 = monotonic()
             # We either extract and handle all Notifier objects individually
             for item in nmsg:
                 n = seiscomp.datamodel.Notifier.Cast(item)
                 assert n is not None
                 n.apply()
                 self.handleNotifier(n)
+                if self._horizon is not None:
+                    self._eviction.touch(n, t)
             # OR simply handle the NotifierMessage
 #           self.handleMessage(nmsg)
+            self._applyTime += monotonic() - t0
+
+            if self._horizon is not None:
+                if self._lastEviction is None:
+                    self._lastEviction = t
+                elif t - self._lastEviction >= self._evictInterval:
+                    self._eviction.evict(self._ep, t, self.evictObject)
+                    self._lastEviction = t
+
+            if monotonic() - scheduler.interval.wallStart >= self._statsInterval:
+                seiscomp.logging.info("playback: %s" % scheduler.interval)
+                self._logMemory()
+                scheduler.resetInterval()
 
+        seiscomp.logging.info("playback total: %s" % scheduler.total)
+        self._logTimes(monotonic() - scheduler.total.wallStart)
+        self._logMemory()
         return True
 
     def sync(self, time):
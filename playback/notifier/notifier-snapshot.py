@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys, os, optparse
+import seiscomp.core, seiscomp.datamodel
+import sc3stuff.util
+import notifierlog, notifierstate
+
+description="%prog - write periodic snapshots of the event parameters from notifier logs"
+
+p = optparse.OptionParser(usage="%prog --start-time t1 --end-time t2 [--interval seconds] files", description=description)
+p.add_option("-s", "--start-time", action="store", help="specify time of the first snapshot")
+p.add_option("-e", "--end-time", action="store", help="specify end time")
+p.add_option("-i", "--interval", action="store", type="float", default=3600., help="specify interval between snapshots in seconds (default is 3600)")
+p.add_option("-H", "--horizon", action="store", type="float", help="drop objects not updated for this many seconds and not referenced by an open event (default is to keep all objects)")
+p.add_option("-o", "--output-dir", action="store", help="specify directory for the snapshots (default is the directory of the first input file)")
+p.add_option("-j", "--workers", action="store", type="int", help="number of threads decompressing the input files (default is one per CPU)")
+p.add_option("-v", "--verbose", action="store_true", help="run in verbose mode")
+
+(opt, filenames) = p.parse_args()
+
+def parseTime(s):
+    for fmtstr in "%FT%TZ", "%FT%T.%fZ":
+        t = seiscomp.core.Time.GMT()
+        if t.fromString(s, fmtstr):
+            return t
+    raise ValueError("could not parse time string '%s'" %s)
+
+if not filenames:
+    p.error("no input files specified")
+
+outputDir = opt.output_dir or os.path.dirname(filenames[0]) or "."
+startTime = endTime = None
+if opt.start_time:
+    startTime = notifierlog.formatTime(parseTime(opt.start_time))
+if opt.end_time:
+    endTime = notifierlog.formatTime(parseTime(opt.end_time))
+
+# Continue from the latest earlier snapshot if there is one, otherwise
+# start with an empty state at the beginning of the logs.
+if startTime is not None:
+    ep, stateTime = notifierstate.loadState(outputDir, startTime)
+    if stateTime is not None and opt.verbose:
+        print("continuing from snapshot at %s" % stateTime, file=sys.stderr)
+else:
+    ep, stateTime = seiscomp.datamodel.EventParameters(), None
+
+# The notifiers between the snapshot, or the first snapshot to write,
+# and the start of the logs would be missing from the state.
+first = notifierlog.logStart(filenames)
+if (stateTime or startTime) is not None and (first is None or first > (stateTime or startTime)):
+    print("the logs start at %s, after %s; give earlier logs" % (first, stateTime or startTime), file=sys.stderr)
+    sys.exit(1)
+
+# Without horizon, objects are never dropped, so each snapshot holds
+# every object ever logged.
+eviction = None
+if opt.horizon is not None:
+    eviction = notifierstate.Eviction(opt.horizon)
+    if stateTime is not None:
+        t = notifierlog.seconds(stateTime)
+        for iterator in [ sc3stuff.util.EventParametersPicks, sc3stuff.util.EventParametersAmplitudes,
+                          sc3stuff.util.EventParametersOrigins, sc3stuff.util.EventParametersFocalMechanisms,
+                          sc3stuff.util.EventParametersEvents ]:
+            for obj in iterator(ep):
+                eviction.seen(obj.publicID(), t)
+
+def writeSnapshot(timestamp):
+    if eviction is not None:
+        eviction.evict(ep, notifierlog.seconds(timestamp))
+    filename = notifierlog.snapshotFileName(outputDir, timestamp)
+    notifierstate.writeSnapshot(ep, filename)
+    if opt.verbose:
+        print("wrote %s: %d events  %d origins  %d picks  %d amplitudes  %d focal mechanisms" % (
+            filename, ep.eventCount(), ep.originCount(), ep.pickCount(),
+            ep.amplitudeCount(), ep.focalMechanismCount()), file=sys.stderr)
+
+checkpoint = None
+if startTime is not None:
+    checkpoint = notifierlog.seconds(startTime)
+
+for entry in notifierlog.mergeEntries(filenames, stateTime, endTime, opt.workers):
+    if stateTime is not None and entry.time <= stateTime:
+        # already contained in the snapshot
+        continue
+    t = notifierlog.seconds(entry.time)
+    if checkpoint is None:
+        # first snapshot at the first full interval
+        checkpoint = (t // opt.interval + 1) * opt.interval
+    while checkpoint < t:
+        writeSnapshot(notifierlog.formatSeconds(checkpoint))
+        checkpoint += opt.interval
+    touch = None
+    if eviction is not None:
+        touch = lambda n: eviction.touch(n, t)
+    notifierstate.applyNotifierMessage(notifierstate.readNotifierMessage(entry.xml), touch)
+
+if endTime is not None and checkpoint is not None:
+    while checkpoint <= notifierlog.seconds(endTime):
+        writeSnapshot(notifierlog.formatSeconds(checkpoint))
+        checkpoint += opt.interval
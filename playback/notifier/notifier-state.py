@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys, optparse
+import seiscomp.core
+import sc3stuff.util
+import notifierlog, notifierstate
+
+description="%prog - reconstruct the state of an event at a given time from notifier logs"
+
+p = optparse.OptionParser(usage="%prog --event id [--time t] [--timeline] files", description=description)
+p.add_option("-E", "--event", action="store", help="specify event ID")
+p.add_option("-t", "--time", action="store", help="specify time of the state (default is the end of the logs)")
+p.add_option("--timeline", action="store_true", help="print a summary line for each change of the event up to the specified time instead of the XML")
+p.add_option("-f", "--formatted", action="store_true", help="write formatted XML")
+p.add_option("-j", "--workers", action="store", type="int", help="number of threads decompressing the input files (default is one per CPU)")
+
+(opt, filenames) = p.parse_args()
+
+def parseTime(s):
+    for fmtstr in "%FT%TZ", "%FT%T.%fZ":
+        t = seiscomp.core.Time.GMT()
+        if t.fromString(s, fmtstr):
+            return t
+    raise ValueError("could not parse time string '%s'" %s)
+
+if not opt.event:
+    p.error("no event ID specified")
+if not filenames:
+    p.error("no input files specified")
+
+endTime = None
+if opt.time:
+    endTime = notifierlog.formatTime(parseTime(opt.time))
+
+if opt.timeline:
+    for timestamp, state in notifierstate.eventTimeline(filenames, opt.event, endTime, opt.workers):
+        print("%s  %s" % (timestamp, state.summary()))
+    sys.exit(0)
+
+state = notifierstate.eventState(filenames, opt.event, endTime, opt.workers)
+if state is None or state.event() is None:
+    print("event %s not found" % opt.event, file=sys.stderr)
+    sys.exit(1)
+
+print(state.summary(), file=sys.stderr)
+state.prune()
+sc3stuff.util.writeEventParametersToXML(state.ep, "-", opt.formatted)
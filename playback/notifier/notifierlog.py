@@ -0,0 +1,891 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reading and indexing of notifier logs as written by notifier-logger.py
+
+Each log entry consists of a header line like
+
+  ####  2018-06-14T00:00:53.270025Z  1bd21eabe25cfa2762a978201756bd88  1030 bytes
+
+followed by the XML document of one NotifierMessage. The time stamps
+are written with fixed width and can therefore be compared as strings.
+
+Logs are either plain text, optionally gzipped, or block-compressed
+segments (extension ".nlz") as written by SegmentWriter. A segment is
+a sequence of independently zlib-compressed blocks, each of which
+holds a number of complete log entries in the plain text format. Each
+block is preceded by a block header line like
+
+  ##Z  2018-06-14T00:00:53.270025Z  2018-06-14T00:01:02.102934Z  143  40213 bytes
+
+containing the time stamps of the first and last entry, the number
+of entries and the size of the compressed block.
+
+Next to each log file a sidecar index (see indexFileName()) maps the
+header time stamps to the byte offsets of the header lines, or in
+case of segments, the time stamps of the first entries to the
+offsets of the blocks. This allows to seek directly to the beginning
+of a time window instead of scanning the log from the start. If
+there is no index, it is built on first use.
+
+A second sidecar index, the object index (see objectIndexFileName()),
+lists for each notifier the operation, the class of the object, its
+publicID (or for OriginReference and FocalMechanismReference objects
+the referenced ID) and the parentID, together with the location of
+the log entry. It allows to select the entries related to an event
+or object without parsing any XML.
+
+This module doesn't depend on the SeisComP libraries.
+"""
+
+from __future__ import print_function
+import os, re, time, calendar, bisect, collections, heapq, itertools, hashlib, gzip, zlib
+import xml.etree.ElementTree
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+
+segmentExtension = ".nlz"
+
+
+class Entry(object):
+    """
+    One entry of a notifier log. The xml attribute holds the raw
+    (undecoded) XML document.
+    """
+    def __init__(self, timestamp, md5hash, nbytes, offset, line, blockPos=None):
+        self.time = timestamp
+        self.md5 = md5hash
+        self.nbytes = nbytes
+        # offset of the header line or, for segments, of the block
+        self.offset = offset
+        # offset of the header line within the uncompressed block
+        self.blockPos = blockPos
+        self.line = line
+        self.xml = None
+
+
+def formatTime(time):
+    """
+    Convert a seiscomp.core.Time to a header time stamp
+    """
+    return time.toString("%Y-%m-%dT%H:%M:%S.%f000000")[:26]+"Z"
+
+
+def _str(s):
+    if isinstance(s, str):
+        return s
+    return s.decode("ascii")
+
+
+def parseHeader(line):
+    """
+    Parse a header line and return the tuple (timestamp, md5hash, nbytes).
+    md5hash is None for old-style headers without hash. If the line is
+    not a valid header line, None is returned.
+    """
+    try:
+        fields = _str(line).split()
+    except UnicodeDecodeError:
+        return
+    if len(fields) == 3:
+        sharp, timestamp, nbytes = fields
+        md5hash = None
+    elif len(fields) == 4:
+        sharp, timestamp, nbytes, sbytes = fields
+        md5hash = None
+        if sbytes != "bytes":
+            return
+    elif len(fields) == 5:
+        sharp, timestamp, md5hash, nbytes, sbytes = fields
+        if sbytes != "bytes":
+            return
+    else:
+        return
+    if sharp[0] != "#" or not nbytes.isdigit():
+        return
+    return timestamp, md5hash, int(nbytes)
+
+
+def parseBlockHeader(line):
+    """
+    Parse a block header line and return the tuple (firstTime,
+    lastTime, count, nbytes) or None if the line is not a valid block
+    header line.
+    """
+    try:
+        fields = _str(line).split()
+    except UnicodeDecodeError:
+        return
+    if len(fields) != 6 or fields[0] != "##Z" or fields[5] != "bytes":
+        return
+    if not fields[3].isdigit() or not fields[4].isdigit():
+        return
+    return fields[1], fields[2], int(fields[3]), int(fields[4])
+
+
+def isSegment(filename):
+    return filename.endswith(segmentExtension)
+
+
+def openLog(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def indexFileName(filename):
+    """
+    Name of the index file belonging to the specified log file. A
+    gzipped log shares the index with the uncompressed log, as the
+    offsets refer to the uncompressed data.
+    """
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    elif isSegment(filename):
+        filename = filename[:-len(segmentExtension)]
+    return filename + ".idx"
+
+
+def _scanHeaders(f):
+    """
+    Yield (offset, line, header) for all log entries starting at the
+    current position of the file. The XML documents are skipped.
+    """
+    while True:
+        offset = f.tell()
+        raw = f.readline()
+        if not raw:
+            # empty input / EOF
+            return
+        line = raw.strip()
+        if not line:
+            # blank line
+            continue
+        if line[:1] != b"#":
+            continue
+        header = parseHeader(line)
+        if header is None:
+            return
+        yield offset, line, header
+        f.seek(offset + len(raw) + header[2])
+
+
+def _scanBlocks(f):
+    """
+    Yield (offset, header) for all complete blocks of a segment
+    starting at the current position of the file. If the data of a
+    block is read by the caller, it must be read completely.
+    """
+    size = os.fstat(f.fileno()).st_size
+    while True:
+        offset = f.tell()
+        raw = f.readline()
+        header = parseBlockHeader(raw)
+        if header is None:
+            # EOF or garbage, e.g. left by a crashed writer
+            return
+        end = offset + len(raw) + header[3]
+        if end > size:
+            # incomplete last block
+            return
+        yield offset, header
+        f.seek(end)
+
+
+def scanIndex(filename):
+    """
+    Build the index of a log file by scanning all header lines.
+    Returns the lists of time stamps and offsets.
+    """
+    timestamps, offsets = [], []
+    f = openLog(filename)
+    if isSegment(filename):
+        for offset, header in _scanBlocks(f):
+            timestamps.append(header[0])
+            offsets.append(offset)
+    else:
+        for offset, line, header in _scanHeaders(f):
+            timestamps.append(header[0])
+            offsets.append(offset)
+    f.close()
+    return timestamps, offsets
+
+
+def writeIndex(filename, timestamps, offsets):
+    idxFileName = indexFileName(filename)
+    tmpFileName = idxFileName + ".tmp"
+    with open(tmpFileName, "w") as f:
+        for timestamp, offset in zip(timestamps, offsets):
+            f.write("%s %d\n" % (timestamp, offset))
+    os.rename(tmpFileName, idxFileName)
+
+
+def readIndex(filename):
+    """
+    Read the index of a log file. Returns the lists of time stamps
+    and offsets or None if there is no index.
+    """
+    timestamps, offsets = [], []
+    try:
+        f = open(indexFileName(filename))
+    except IOError:
+        return
+    for line in f:
+        try:
+            timestamp, offset = line.split()
+            offset = int(offset)
+        except ValueError:
+            # incomplete last line of an index that is being written
+            break
+        timestamps.append(timestamp)
+        offsets.append(offset)
+    f.close()
+    return timestamps, offsets
+
+
+def loadIndex(filename, rebuild=False):
+    """
+    Read the index of a log file. If there is none, it is built and,
+    if possible, saved for later use.
+    """
+    index = None if rebuild else readIndex(filename)
+    if index is None:
+        index = scanIndex(filename)
+        try:
+            writeIndex(filename, *index)
+        except (IOError, OSError):
+            # e.g. read-only directory; use the index in memory only
+            pass
+    return index
+
+
+def logStart(filenames):
+    """
+    The time stamp from which on several log files are complete, or
+    None if they are empty. That is the beginning of the hour of the
+    earliest segment, as a segment holds all entries of its hour, and
+    for other logs the earliest time stamp according to their indexes.
+    """
+    first = None
+    for filename in filenames:
+        timestamps, offsets = loadIndex(filename)
+        if not timestamps:
+            continue
+        t = timestamps[0]
+        if isSegment(filename):
+            t = t[:13] + ":00:00.000000Z"
+        if first is None or t < first:
+            first = t
+    return first
+
+
+class IndexWriter(object):
+    """
+    Appends entries to the index of a log file while it is written.
+    """
+
+    def __init__(self, filename):
+        self.filename = indexFileName(filename)
+        if not os.path.exists(self.filename) and \
+               os.path.exists(filename) and os.path.getsize(filename) > 0:
+            # the log is continued but has no index yet
+            writeIndex(filename, *scanIndex(filename))
+        self._f = open(self.filename, "a")
+
+    def add(self, timestamp, offset):
+        self._f.write("%s %d\n" % (timestamp, offset))
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def _seek(f, index, startTime, parse=parseHeader):
+    """
+    Position the file at the last indexed entry earlier than
+    startTime. Entries from there on may be within the time window,
+    which in case of a block means that the block may contain entries
+    within the time window. Returns False if the index doesn't match
+    the log.
+    """
+    timestamps, offsets = index
+    if not offsets:
+        return True
+    i = max(bisect.bisect_left(timestamps, startTime) - 1, 0)
+    f.seek(offsets[i])
+    header = parse(f.readline())
+    if header is None or header[0] != timestamps[i]:
+        return False
+    f.seek(offsets[i])
+    return True
+
+
+def _seekTime(f, filename, startTime, parse=parseHeader):
+    if not _seek(f, loadIndex(filename), startTime, parse):
+        # stale index
+        if not _seek(f, loadIndex(filename, rebuild=True), startTime, parse):
+            f.seek(0)
+
+
+def _decompress(blocks, pool, readahead):
+    """
+    Decompress the (offset, data) tuples of blocks in a pool of worker
+    threads while preserving their order. zlib releases the global
+    interpreter lock, so the blocks are really decompressed in
+    parallel. At most readahead blocks are processed ahead. Without
+    pool the blocks are decompressed sequentially.
+    """
+    if pool is None:
+        for offset, data in blocks:
+            yield offset, zlib.decompress(data)
+        return
+
+    pending = collections.deque()
+    for offset, data in blocks:
+        pending.append((offset, pool.apply_async(zlib.decompress, (data,))))
+        if len(pending) >= readahead:
+            offset, result = pending.popleft()
+            yield offset, result.get()
+    while pending:
+        offset, result = pending.popleft()
+        yield offset, result.get()
+
+
+def _readSegment(filename, startTime, endTime, pool, readahead):
+    f = openLog(filename)
+    if startTime is not None:
+        _seekTime(f, filename, startTime, parseBlockHeader)
+
+    def blocks():
+        for offset, header in _scanBlocks(f):
+            firstTime, lastTime, count, nbytes = header
+            if startTime is not None and lastTime < startTime:
+                continue
+            if endTime is not None and firstTime > endTime:
+                break
+            yield offset, f.read(nbytes)
+
+    try:
+        for offset, data in _decompress(blocks(), pool, readahead):
+            block = BytesIO(data)
+            for pos, line, header in _scanHeaders(block):
+                timestamp, md5hash, nbytes = header
+                if startTime is not None and timestamp < startTime:
+                    continue
+                if endTime is not None and timestamp > endTime:
+                    return
+                entry = Entry(timestamp, md5hash, nbytes, offset, _str(line), pos)
+                entry.xml = block.read(nbytes)
+                yield entry
+    finally:
+        f.close()
+
+
+def _readPlain(filename, startTime, endTime):
+    f = openLog(filename)
+    if startTime is not None:
+        _seekTime(f, filename, startTime)
+
+    try:
+        for offset, line, header in _scanHeaders(f):
+            timestamp, md5hash, nbytes = header
+            if startTime is not None and timestamp < startTime:
+                continue
+            if endTime is not None and timestamp > endTime:
+                break
+            entry = Entry(timestamp, md5hash, nbytes, offset, _str(line))
+            entry.xml = f.read(nbytes)
+            yield entry
+    finally:
+        f.close()
+
+
+def readEntries(filename, startTime=None, endTime=None, workers=None):
+    """
+    Yield the entries of a log file within the optional time window.
+    startTime and endTime are header time stamps (see formatTime()).
+
+    The blocks of a segment are decompressed by the specified number
+    of worker threads, by default one per CPU.
+    """
+    if not isSegment(filename):
+        for entry in _readPlain(filename, startTime, endTime):
+            yield entry
+        return
+
+    if workers is None:
+        workers = _cpuCount()
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        for entry in _readSegment(filename, startTime, endTime, pool, 2*workers):
+            yield entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def objectIndexFileName(filename):
+    """
+    Name of the object index belonging to the specified log file
+    """
+    return indexFileName(filename)[:-4] + ".oidx"
+
+
+def formatObjectRow(timestamp, offset, blockPos, obj):
+    """
+    Format one line of the object index. obj is the tuple (operation,
+    className, objectID, parentID) of one notifier.
+    """
+    fields = [timestamp, str(offset), "-" if blockPos is None else str(blockPos)]
+    fields.extend([ f or "-" for f in obj ])
+    return " ".join(fields) + "\n"
+
+
+def _tag(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def objectsFromXML(data):
+    """
+    Extract the (operation, className, objectID, parentID) tuples of
+    all notifiers from the XML document of a NotifierMessage. Used to
+    index logs written without object index.
+    """
+    objects = []
+    root = xml.etree.ElementTree.fromstring(data)
+    for notifier in root.iter():
+        if _tag(notifier) != "notifier":
+            continue
+        for child in notifier:
+            tag = _tag(child)
+            if tag in [ "originReference", "focalMechanismReference" ]:
+                objectID = (child.text or "").strip()
+            else:
+                objectID = child.get("publicID")
+            objects.append((notifier.get("operation"), tag[0].upper()+tag[1:],
+                            objectID, notifier.get("parentID")))
+            break
+    return objects
+
+
+def scanObjectIndex(filename):
+    """
+    Build the object index of a log file by parsing all entries.
+    Returns the list of index lines.
+    """
+    lines = []
+    for entry in readEntries(filename, workers=1):
+        for obj in objectsFromXML(entry.xml):
+            lines.append(formatObjectRow(entry.time, entry.offset, entry.blockPos, obj))
+    return lines
+
+
+def writeObjectIndex(filename, lines):
+    oidxFileName = objectIndexFileName(filename)
+    with open(oidxFileName + ".tmp", "w") as f:
+        f.writelines(lines)
+    os.rename(oidxFileName + ".tmp", oidxFileName)
+
+
+def _isLive(filename, age=600):
+    # A segment of the current hour or modified within the last 'age'
+    # seconds may still be written by a SegmentWriter.
+    if not isSegment(filename):
+        return False
+    hour = time.strftime("%Y-%m-%dT%H", time.gmtime())
+    return filename.endswith(".%s:00:00Z%s" % (hour, segmentExtension)) or \
+           time.time() - os.path.getmtime(filename) < age
+
+
+def loadObjectIndex(filename):
+    """
+    Read the lines of the object index of a log file. If there is
+    none or it is older than the log, it is built and, if possible,
+    saved for later use.
+
+    A SegmentWriter touches the object index after each block, so
+    that it is only older than the segment while a block is being
+    written. The index of a segment that may still be written is
+    therefore never replaced, as the writer holds it open; it is
+    built in memory instead.
+    """
+    oidxFileName = objectIndexFileName(filename)
+    try:
+        if os.path.getmtime(oidxFileName) >= os.path.getmtime(filename):
+            with open(oidxFileName) as f:
+                return f.readlines()
+    except (IOError, OSError):
+        pass
+    lines = scanObjectIndex(filename)
+    if _isLive(filename):
+        return lines
+    try:
+        writeObjectIndex(filename, lines)
+    except (IOError, OSError):
+        pass
+    return lines
+
+
+def selectObjects(lines, eventID=None, className=None, publicID=None, startTime=None, endTime=None):
+    """
+    Select the entries from the object index lines that contain
+    notifiers of objects of the specified class and/or related to
+    the specified event or object. An object is related if it is the
+    specified one, is referenced by it (origins and focal mechanisms
+    of an event) or is a descendant of a related object. Returns the
+    set of (offset, blockPos) tuples of the selected entries.
+    """
+    rows = []
+    ids = set([ i for i in (eventID, publicID) if i ])
+    if ids:
+        # Collect the related objects iteratively. Only the index lines
+        # containing one of the newly found IDs are looked at in each
+        # round.
+        related = set()
+        new = ids
+        while new:
+            related |= new
+            pattern = re.compile("|".join(re.escape(i) for i in new))
+            new = set()
+            for line in lines:
+                if not pattern.search(line):
+                    continue
+                row = line.split()
+                objectID, parentID = row[5], row[6]
+                if objectID in related or parentID in related:
+                    rows.append(row)
+                    if objectID != "-" and objectID not in related:
+                        new.add(objectID)
+    else:
+        rows = [ line.split() for line in lines if className is None or className in line ]
+
+    selected = set()
+    for row in rows:
+        if className is not None and row[4] != className:
+            continue
+        if startTime is not None and row[0] < startTime:
+            continue
+        if endTime is not None and row[0] > endTime:
+            continue
+        selected.add((int(row[1]), None if row[2] == "-" else int(row[2])))
+    return selected
+
+
+def readEntriesAt(filename, locations, pool=None, readahead=2):
+    """
+    Yield the entries at the specified (offset, blockPos) locations of
+    a log file in the order of their locations. Only the blocks of a
+    segment that contain selected entries are decompressed.
+    """
+    f = openLog(filename)
+    try:
+        if not isSegment(filename):
+            for offset, blockPos in sorted(locations):
+                f.seek(offset)
+                line = f.readline().strip()
+                timestamp, md5hash, nbytes = parseHeader(line)
+                entry = Entry(timestamp, md5hash, nbytes, offset, _str(line))
+                entry.xml = f.read(nbytes)
+                yield entry
+            return
+
+        positions = collections.defaultdict(list)
+        for offset, blockPos in locations:
+            positions[offset].append(blockPos)
+
+        def blocks():
+            for offset in sorted(positions):
+                f.seek(offset)
+                header = parseBlockHeader(f.readline())
+                if header is None:
+                    # indexed, but not yet written, see SegmentWriter.flush()
+                    return
+                data = f.read(header[3])
+                if len(data) < header[3]:
+                    return
+                yield offset, data
+
+        for offset, data in _decompress(blocks(), pool, readahead):
+            block = BytesIO(data)
+            for pos in sorted(positions[offset]):
+                block.seek(pos)
+                line = block.readline().strip()
+                timestamp, md5hash, nbytes = parseHeader(line)
+                entry = Entry(timestamp, md5hash, nbytes, offset, _str(line), pos)
+                entry.xml = block.read(nbytes)
+                yield entry
+    finally:
+        f.close()
+
+
+def _prefetch(entries, pool, chunkSize=256):
+    """
+    Read the entries of a plain or gzipped log in chunks in the pool
+    while the previous chunk is consumed. Only one chunk per log is
+    read at a time, so the generator is never run concurrently.
+    """
+    def nextChunk():
+        return list(itertools.islice(entries, chunkSize))
+
+    result = pool.apply_async(nextChunk)
+    while True:
+        chunk = result.get()
+        if not chunk:
+            return
+        result = pool.apply_async(nextChunk)
+        for entry in chunk:
+            yield entry
+
+
+def seconds(timestamp):
+    """
+    Convert a header time stamp to seconds since the epoch
+    """
+    t = calendar.timegm(time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+    return t + float("0" + timestamp[19:-1])
+
+
+def formatSeconds(t):
+    """
+    Convert seconds since the epoch to a header time stamp
+    """
+    us = int(round(t * 1000000))
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(us // 1000000)) + ".%06dZ" % (us % 1000000)
+
+
+snapshotPrefix = "notifier-snapshot."
+
+
+def snapshotFileName(directory, timestamp):
+    """
+    Name of the snapshot file of the state at the specified time stamp
+    """
+    return os.path.join(directory, "%s%s.xml" % (snapshotPrefix, timestamp))
+
+
+def findSnapshot(directory, timestamp):
+    """
+    Find the latest snapshot in directory not later than the
+    specified time stamp. Returns the tuple (filename, timestamp) or
+    None if there is no such snapshot.
+    """
+    best = None
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(snapshotPrefix) or not name.endswith(".xml"):
+            continue
+        t = name[len(snapshotPrefix):-4]
+        if t <= timestamp and (best is None or t > best[1]):
+            best = (os.path.join(directory, name), t)
+    return best
+
+
+def mergeEntries(filenames, startTime=None, endTime=None, workers=None, window=60., select=None):
+    """
+    Yield the entries of several log files within the optional time
+    window, merged into one sequence ordered by time stamp. The logs
+    may be plain, gzipped or segments, and each is expected to be
+    ordered by time, which is the case for logs written by
+    notifier-logger.py.
+
+    Duplicate entries, e.g. in case of overlapping logs or logs from
+    redundant loggers, are identified by their MD5 hash and dropped
+    if they occur within window seconds of each other.
+
+    If select is specified, it is called with each file name and
+    returns the set of (offset, blockPos) locations of the entries to
+    read from that file, e.g. using selectObjects().
+
+    Returns an EntryMerger, which counts the dropped duplicates.
+    """
+    return EntryMerger(filenames, startTime, endTime, workers, window, select)
+
+
+class EntryMerger(object):
+    """
+    Iterable over the merged entries of several log files, see
+    mergeEntries(). Memory usage is bounded by the read-ahead per log
+    and the number of entries within the duplicate window, regardless
+    of the length of the logs.
+
+    The logs are decompressed in a shared pool of worker threads:
+    blocks of segments individually, plain and gzipped logs in chunks.
+    """
+
+    def __init__(self, filenames, startTime=None, endTime=None, workers=None, window=60., select=None):
+        self.filenames = filenames
+        self.startTime = startTime
+        self.endTime = endTime
+        self.workers = workers if workers is not None else _cpuCount()
+        self.window = window
+        self.select = select
+        self.duplicates = 0
+
+    def __iter__(self):
+        pool = ThreadPool(self.workers)
+        readahead = max(2, 2*self.workers // max(len(self.filenames), 1))
+
+        def keyed(i, entries):
+            for n, entry in enumerate(entries):
+                yield entry.time, i, n, entry
+
+        streams = []
+        for i, filename in enumerate(self.filenames):
+            if self.select is not None:
+                entries = readEntriesAt(filename, self.select(filename), pool, readahead)
+                if not isSegment(filename):
+                    entries = _prefetch(entries, pool)
+            elif isSegment(filename):
+                entries = _readSegment(filename, self.startTime, self.endTime, pool, readahead)
+            else:
+                entries = _prefetch(_readPlain(filename, self.startTime, self.endTime), pool)
+            streams.append(keyed(i, entries))
+
+        # md5 hashes seen within the duplicate window
+        seen = {}
+        recent = collections.deque()
+        try:
+            for timestamp, i, n, entry in heapq.merge(*streams):
+                md5hash = entry.md5 or hashlib.md5(entry.xml).hexdigest()
+                t = seconds(timestamp)
+                while recent and recent[0][0] < t - self.window:
+                    del seen[recent.popleft()[1]]
+                if md5hash in seen:
+                    self.duplicates += 1
+                    continue
+                seen[md5hash] = t
+                recent.append((t, md5hash))
+                yield entry
+        finally:
+            for stream in streams:
+                stream.close()
+            pool.terminate()
+
+
+def _cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class SegmentWriter(object):
+    """
+    Writes log entries to hourly block-compressed segments named
+    prefix.YYYY-MM-DDTHH:00:00Z.nlz and maintains their indexes.
+
+    Entries are collected until the uncompressed block size reaches
+    blockSize bytes or the oldest entry in the block is older than
+    flushInterval seconds. The block is then compressed and written.
+    """
+
+    def __init__(self, prefix, blockSize=256*1024, flushInterval=10.):
+        self.prefix = prefix
+        self.blockSize = blockSize
+        self.flushInterval = flushInterval
+        self.filename = None
+        self._f = self._index = None
+        self._hour = None
+        self._block = []
+        self._blockBytes = 0
+        self._blockStarted = None
+        self._objects = []
+        self._objectIndex = None
+        # number of compressed bytes written so far
+        self.bytesWritten = 0
+
+    def _open(self, timestamp):
+        self._hour = timestamp[:13]
+        self.filename = "%s.%s:00:00Z%s" % (self.prefix, self._hour, segmentExtension)
+        if os.path.exists(self.filename):
+            # Continue an existing segment, but drop the incomplete
+            # last block possibly left by a crashed writer.
+            f = open(self.filename, "rb")
+            end = 0
+            for offset, header in _scanBlocks(f):
+                end = f.tell() + header[3]
+            f.close()
+            if end < os.path.getsize(self.filename):
+                with open(self.filename, "r+b") as f:
+                    f.truncate(end)
+            # The indexes may be missing, e.g. for a segment written by
+            # an older version, or refer to a block that was dropped or
+            # never written, so they are rebuilt.
+            writeIndex(self.filename, *scanIndex(self.filename))
+            writeObjectIndex(self.filename, scanObjectIndex(self.filename))
+        self._index = IndexWriter(self.filename)
+        self._objectIndex = open(objectIndexFileName(self.filename), "a")
+        self._f = open(self.filename, "ab")
+        self._f.seek(0, 2)
+
+    def _close(self):
+        self.flush()
+        if self._f is not None:
+            self._f.close()
+            self._index.close()
+            self._objectIndex.close()
+            self._f = self._index = self._objectIndex = None
+
+    def add(self, timestamp, header, xml, objects=()):
+        """
+        Add one log entry. header is the header line without newline
+        and xml the serialized NotifierMessage. objects is the list of
+        (operation, className, objectID, parentID) tuples of the
+        notifiers in the message, see formatObjectRow().
+        """
+        if self._hour != timestamp[:13]:
+            self._close()
+            self._open(timestamp)
+        if not self._block:
+            self._blockStarted = time.time()
+        data = header.encode() + b"\n" + xml + b"\n"
+        for obj in objects:
+            self._objects.append((timestamp, self._blockBytes, obj))
+        self._block.append((timestamp, data))
+        self._blockBytes += len(data)
+        if self._blockBytes >= self.blockSize:
+            self.flush()
+
+    def flushIfDue(self, sync=False):
+        if self._block and time.time() - self._blockStarted >= self.flushInterval:
+            self.flush(sync)
+
+    def flush(self, sync=False):
+        """
+        Compress and write the current block. If sync is True, the
+        segment is also synced to disk.
+        """
+        if not self._block:
+            return
+        data = zlib.compress(b"".join(data for timestamp, data in self._block))
+        firstTime, lastTime = self._block[0][0], self._block[-1][0]
+        offset = self._f.tell()
+        # The object index rows are written before the block and the
+        # object index is touched afterwards, so that it is never older
+        # than the segment except while the block is written, see
+        # loadObjectIndex().
+        if self._objects:
+            self._objectIndex.writelines(
+                formatObjectRow(timestamp, offset, pos, obj) for timestamp, pos, obj in self._objects)
+            self._objectIndex.flush()
+        self._f.write(("##Z  %s  %s  %d  %d bytes\n" % (
+            firstTime, lastTime, len(self._block), len(data))).encode())
+        self._f.write(data)
+        self._f.flush()
+        if sync:
+            os.fsync(self._f.fileno())
+        self._index.add(firstTime, offset)
+        self.bytesWritten += self._f.tell() - offset
+        os.utime(self._objectIndex.name, None)
+        self._block = []
+        self._objects = []
+        self._blockBytes = 0
+
+    def close(self):
+        self._close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reconstruction of the state of event parameters from notifier logs
+and snapshots of that state
+"""
+
+from __future__ import print_function
+import os
+import seiscomp.datamodel, seiscomp.io, seiscomp.utils
+import sc3stuff.util
+import notifierlog
+
+
+def readNotifierMessage(xml):
+    """
+    Parse the XML document of a notifier log entry
+    """
+    b = seiscomp.utils.stringToStreambuf(xml.strip())
+    ar = seiscomp.io.XMLArchive(b)
+    obj = ar.readObject()
+    if obj is None:
+        raise TypeError("got invalid xml")
+    nmsg = seiscomp.datamodel.NotifierMessage.Cast(obj)
+    if nmsg is None:
+        raise TypeError("no NotifierMessage object found")
+    return nmsg
+
+
+def applyNotifierMessage(nmsg, touch=None):
+    # touch is called with each applied notifier, e.g. Eviction.touch
+    for item in nmsg:
+        n = seiscomp.datamodel.Notifier.Cast(item)
+        if n:
+            n.apply()
+            if touch is not None:
+                touch(n)
+
+
+def readSnapshot(filename):
+    """
+    Read a snapshot, i.e. an EventParameters instance holding all
+    objects that were alive at the time of the snapshot
+    """
+    return sc3stuff.util.readEventParametersFromXML(filename)
+
+
+def writeSnapshot(ep, filename):
+    # write to a temporary file first so that a player never sees an
+    # incomplete snapshot
+    tmp = filename + ".tmp"
+    sc3stuff.util.writeEventParametersToXML(ep, tmp)
+    os.rename(tmp, filename)
+
+
+class Eviction(object):
+    """
+    Keeps track of the data times at which objects were last touched
+    by a notifier and removes the objects that are no longer alive,
+    i.e. that were not touched within the horizon (in seconds) and are
+    not referenced by an open event, which is an event touched within
+    the horizon. The number of evicted objects is counted in 'evicted'.
+    """
+
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.evicted = 0
+        self._lastSeen = {}
+
+    def seen(self, publicID, t):
+        self._lastSeen[publicID] = t
+
+    def touch(self, n, t):
+        """
+        Record the data time t at which the object of notifier n and
+        its parent were last touched
+        """
+        po = seiscomp.datamodel.PublicObject.Cast(n.object())
+        if po:
+            self._lastSeen[po.publicID()] = t
+        self._lastSeen[n.parentID()] = t
+
+    def evict(self, ep, t, evicted=None):
+        """
+        Remove all objects from the EventParameters that are no longer
+        alive at t. evicted is called with each removed object.
+        """
+        cutoff = t - self.horizon
+
+        def stale(publicID):
+            return self._lastSeen.get(publicID, t) < cutoff
+
+        # objects referenced by open events
+        keep = set()
+        for evt in sc3stuff.util.EventParametersEvents(ep):
+            if stale(evt.publicID()):
+                continue
+            keep.add(evt.preferredOriginID())
+            for i in range(evt.originReferenceCount()):
+                keep.add(evt.originReference(i).originID())
+            for i in range(evt.focalMechanismReferenceCount()):
+                keep.add(evt.focalMechanismReference(i).focalMechanismID())
+        for fm in sc3stuff.util.EventParametersFocalMechanisms(ep):
+            if fm.publicID() not in keep:
+                continue
+            keep.add(fm.triggeringOriginID())
+            for i in range(fm.momentTensorCount()):
+                keep.add(fm.momentTensor(i).derivedOriginID())
+        for org in sc3stuff.util.EventParametersOrigins(ep):
+            if org.publicID() not in keep:
+                continue
+            for i in range(org.arrivalCount()):
+                keep.add(org.arrival(i).pickID())
+            for i in range(org.stationMagnitudeCount()):
+                keep.add(org.stationMagnitude(i).amplitudeID())
+        # the amplitudes of kept picks are kept as well; they must be in
+        # keep so that their times are not dropped below
+        for ampl in sc3stuff.util.EventParametersAmplitudes(ep):
+            if ampl.pickID() in keep:
+                keep.add(ampl.publicID())
+
+        def evict(count, get, remove):
+            n = 0
+            for i in reversed(range(count())):
+                # FIXME: The cast hack forces the SC3 refcounter to be increased.
+                obj = seiscomp.datamodel.PublicObject.Cast(get(i))
+                publicID = obj.publicID()
+                if publicID in keep or not stale(publicID):
+                    continue
+                remove(i)
+                self._lastSeen.pop(publicID, None)
+                if evicted is not None:
+                    evicted(obj)
+                n += 1
+            return n
+
+        n  = evict(ep.eventCount, ep.event, ep.removeEvent)
+        n += evict(ep.focalMechanismCount, ep.focalMechanism, ep.removeFocalMechanism)
+        n += evict(ep.originCount, ep.origin, ep.removeOrigin)
+        n += evict(ep.pickCount, ep.pick, ep.removePick)
+        n += evict(ep.amplitudeCount, ep.amplitude, ep.removeAmplitude)
+        self.evicted += n
+
+        # drop times of objects that were not evicted through the
+        # EventParameters, e.g. children of evicted objects
+        for publicID in [ k for k, v in self._lastSeen.items() if v < cutoff and k not in keep ]:
+            del self._lastSeen[publicID]
+        return n
+
+
+def loadState(directory, timestamp):
+    """
+    Load the latest snapshot in directory not later than timestamp.
+    Returns the tuple (ep, snapshotTime). If there is no snapshot, an
+    empty EventParameters instance and None are returned.
+    """
+    snapshot = notifierlog.findSnapshot(directory, timestamp)
+    if snapshot is None:
+        return seiscomp.datamodel.EventParameters(), None
+    filename, snapshotTime = snapshot
+    return readSnapshot(filename), snapshotTime
+
+
+class EventState(object):
+    """
+    The state of an event and its preferred origin, magnitude and
+    focal mechanism, as reconstructed from a notifier log, see
+    eventTimeline().
+    """
+
+    def __init__(self, ep, eventID):
+        self.ep = ep
+        self.eventID = eventID
+
+    def event(self):
+        return sc3stuff.util.ep_get_event(self.ep, self.eventID)
+
+    def preferredOrigin(self):
+        evt = self.event()
+        if evt:
+            return seiscomp.datamodel.Origin.Find(evt.preferredOriginID())
+
+    def preferredMagnitude(self):
+        evt = self.event()
+        if evt:
+            return seiscomp.datamodel.Magnitude.Find(evt.preferredMagnitudeID())
+
+    def preferredFocalMechanism(self):
+        evt = self.event()
+        if evt:
+            return seiscomp.datamodel.FocalMechanism.Find(evt.preferredFocalMechanismID())
+
+    def summary(self):
+        """
+        One-line summary of the preferred solution
+        """
+        org = self.preferredOrigin()
+        if org is None:
+            return "%s  no preferred origin" % self.eventID
+        line = "%s  %s  %8.3f %8.3f" % (self.eventID,
+            sc3stuff.util.format_time(org.time().value()),
+            org.latitude().value(), org.longitude().value())
+        try:
+            line += " %5.1f km" % org.depth().value()
+        except ValueError:
+            line += "    - km"
+        line += "  %3d phases" % org.arrivalCount()
+        try:
+            line += "  %s" % seiscomp.datamodel.EEvaluationModeNames.name(org.evaluationMode())
+        except ValueError:
+            pass
+        mag = self.preferredMagnitude()
+        if mag:
+            line += "  %s %.2f" % (mag.type(), mag.magnitude().value())
+        fm = self.preferredFocalMechanism()
+        if fm:
+            line += "  FM %s" % fm.publicID()
+        return line
+
+    def prune(self):
+        """
+        Remove all objects from the EventParameters that are not part
+        of the event state, i.e. keep only the event, its preferred
+        origin and focal mechanism and the origins derived from the
+        moment tensors of the latter.
+        """
+        keep = set([self.eventID])
+        evt = self.event()
+        if evt:
+            keep.add(evt.preferredOriginID())
+            keep.add(evt.preferredFocalMechanismID())
+        fm = self.preferredFocalMechanism()
+        if fm:
+            for i in range(fm.momentTensorCount()):
+                keep.add(fm.momentTensor(i).derivedOriginID())
+
+        ep = self.ep
+        for i in reversed(range(ep.pickCount())):
+            ep.removePick(i)
+        for i in reversed(range(ep.amplitudeCount())):
+            ep.removeAmplitude(i)
+        for i in reversed(range(ep.originCount())):
+            if ep.origin(i).publicID() not in keep:
+                ep.removeOrigin(i)
+        for i in reversed(range(ep.focalMechanismCount())):
+            if ep.focalMechanism(i).publicID() not in keep:
+                ep.removeFocalMechanism(i)
+        for i in reversed(range(ep.eventCount())):
+            if ep.event(i).publicID() not in keep:
+                ep.removeEvent(i)
+
+
+def eventTimeline(filenames, eventID, endTime=None, workers=None):
+    """
+    Replay the notifiers related to an event up to endTime (a header
+    time stamp) and yield (timestamp, EventState) after each applied
+    log entry. The entries are selected using the object indexes, so
+    only the notifiers related to the event are parsed.
+
+    The state is built in a new EventParameters instance, so there
+    must not be another EventParameters instance registered.
+    """
+    ep = seiscomp.datamodel.EventParameters()
+    state = EventState(ep, eventID)
+
+    def select(filename):
+        lines = notifierlog.loadObjectIndex(filename)
+        return notifierlog.selectObjects(lines, eventID=eventID, endTime=endTime)
+
+    for entry in notifierlog.mergeEntries(filenames, None, endTime, workers, select=select):
+        applyNotifierMessage(readNotifierMessage(entry.xml))
+        yield entry.time, state
+
+
+def eventState(filenames, eventID, endTime=None, workers=None):
+    """
+    Reconstruct the state of an event at endTime. Returns an EventState
+    or None if there are no notifiers related to the event.
+    """
+    state = None
+    for timestamp, state in eventTimeline(filenames, eventID, endTime, workers):
+        pass
+    return state
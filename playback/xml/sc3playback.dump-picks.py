@@ -2,9 +2,14 @@
 
 from __future__ import print_function
 
-import sys
+import sys, os, time, hashlib
 import seiscomp.core, seiscomp.client, seiscomp.datamodel
 import seiscomp.io, seiscomp.logging
+import sc3stuff.util, sc3stuff.xmlstream
+
+
+def sql_quote(s):
+    return "'%s'" % s.replace("'", "''")
 
 
 def parse_time_string(s):
@@ -15,6 +20,116 @@ def parse_time_string(s):
     print("Wrong time format", file=sys.stderr)
 
 
+class ShardCache(object):
+    """
+    On-disk cache of the picks and amplitudes of fixed time slices
+    ("shards"), stored as binary archives in
+
+        directory/<key>/<shard start time>.bin
+
+    where key is a hash of the database and the filter options. Shards
+    are only stored once they are at least an hour old, as picks may
+    still be added to more recent ones. Loading a shard updates its
+    modification time; if the total size exceeds the limit, the least
+    recently used shards are removed.
+    """
+
+    minAge = 3600.
+
+    def __init__(self, directory, key, shardLength=3600., maxSize=1024*1024*1024):
+        self.directory = directory
+        self.shardLength = shardLength
+        self.maxSize = maxSize
+        self._keyDir = os.path.join(directory, hashlib.md5(key.encode("utf-8")).hexdigest())
+        self.hits = self.misses = 0
+
+    def shardStart(self, t):
+        seconds = t.seconds() // int(self.shardLength) * int(self.shardLength)
+        return seiscomp.core.Time(seconds, 0)
+
+    def _fileName(self, start):
+        return os.path.join(self._keyDir, start.toString("%Y-%m-%dT%H:%M:%S") + ".bin")
+
+    def load(self, start):
+        """
+        Return the EventParameters of the shard starting at 'start' or
+        None if it is not in the cache
+        """
+        filename = self._fileName(start)
+        ar = seiscomp.io.BinaryArchive()
+        if not os.path.exists(filename) or not ar.open(filename):
+            self.misses += 1
+            return None
+        ep = seiscomp.datamodel.EventParameters.Cast(ar.readObject())
+        ar.close()
+        if ep is None:
+            self.misses += 1
+            return None
+        os.utime(filename, None)
+        self.hits += 1
+        return ep
+
+    def cacheable(self, start):
+        """
+        Whether the shard starting at 'start' is old enough to be stored
+        """
+        end = start + seiscomp.core.TimeSpan(self.shardLength)
+        return float(seiscomp.core.Time.GMT() - end) >= self.minAge
+
+    def store(self, start, ep):
+        if not self.cacheable(start):
+            return
+        if not os.path.isdir(self._keyDir):
+            os.makedirs(self._keyDir)
+        filename = self._fileName(start)
+        tmp = filename + ".tmp"
+        ar = seiscomp.io.BinaryArchive()
+        if not ar.create(tmp):
+            seiscomp.logging.warning("could not create %s" % tmp)
+            return
+        ar.writeObject(ep)
+        ar.close()
+        os.rename(tmp, filename)
+        self.evict()
+
+    def _shards(self):
+        # all shard files of all keys as (mtime, size, filename)
+        shards = []
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(".bin"):
+                    filename = os.path.join(root, f)
+                    st = os.stat(filename)
+                    shards.append( (st.st_mtime, st.st_size, filename) )
+        return shards
+
+    def evict(self):
+        shards = sorted(self._shards())
+        size = sum(shard[1] for shard in shards)
+        for mtime, nbytes, filename in shards:
+            if size <= self.maxSize:
+                break
+            os.unlink(filename)
+            size -= nbytes
+
+    def invalidate(self, start=None, end=None):
+        """
+        Remove the shards of all keys overlapping the time window from
+        start to end, or all shards if no time window is given.
+        Returns the number of removed shards.
+        """
+        count = 0
+        for mtime, nbytes, filename in self._shards():
+            if start is not None and end is not None:
+                t = seiscomp.core.Time.GMT()
+                t.fromString(os.path.basename(filename)[:-4], "%Y-%m-%dT%H:%M:%S")
+                if t >= end or t + seiscomp.core.TimeSpan(self.shardLength) <= start:
+                    continue
+            os.unlink(filename)
+            count += 1
+        return count
+
+
 class PickLoader(seiscomp.client.Application):
 
     def __init__(self, argc, argv):
@@ -25,6 +140,15 @@ class PickLoader(seiscomp.client.Application):
         # time window relative to origin time of specified event:
         self._before = 4*3600. # 4 hours
         self._after  = 1*3600. # 1 hour
+        # picks and amplitudes are loaded and written in time slices
+        self._slice = 3600.
+        # with --max-distance only picks from these (net, sta) are kept
+        self._maxDistance = None
+        self._stations = None
+        # number of pick IDs per amplitude query
+        self._batchSize = 500
+        # query statistics: [ seconds, rows, bytes ]
+        self._queryStats = { "picks": [ 0., 0, 0 ], "amplitudes": [ 0., 0, 0 ] }
 
     def createCommandLineDescription(self):
         seiscomp.client.Application.createCommandLineDescription(self)
@@ -35,9 +159,17 @@ class PickLoader(seiscomp.client.Application):
         self.commandline().addStringOption("Dump", "before", "start time window this many seconds before origin time")
         self.commandline().addStringOption("Dump", "after",  "end time window this many seconds after origin time")
         self.commandline().addStringOption("Dump", "origins", "specify space separated list of origin ids to be also loaded")
+        self.commandline().addStringOption("Dump", "max-distance", "with --event, only include picks from stations within this epicentral distance in degrees")
         self.commandline().addStringOption("Dump", "network-blacklist", "specify space separated list of network codes to be excluded")
         self.commandline().addOption("Dump", "no-origins", "don't include any origins")
         self.commandline().addOption("Dump", "no-manual-picks", "don't include any manual picks")
+        self.commandline().addStringOption("Dump", "batch-size", "number of pick IDs per amplitude query (default is 500)")
+        self.commandline().addOption("Dump", "legacy-queries", "load all picks and amplitudes of the time window and filter them here, for comparison")
+        self.commandline().addGroup("Cache")
+        self.commandline().addStringOption("Cache", "cache-dir", "cache the picks and amplitudes in hourly shards in this directory; the hours cached or to be cached are loaded as hourly slices regardless of --slice")
+        self.commandline().addStringOption("Cache", "cache-size", "maximum size of the cache in MB (default is 1024)")
+        self.commandline().addOption("Cache", "invalidate-cache", "remove the cached shards overlapping the time window, or all if there is none, and exit")
+        self.commandline().addStringOption("Dump", "slice", "load and write picks and amplitudes in time slices of this many seconds (default is 3600); with --cache-dir, cached hours are loaded as hourly slices")
 
     def _processCommandLineOptions(self):
         try:    start = self.commandline().optionString("begin")
@@ -79,14 +211,250 @@ class PickLoader(seiscomp.client.Application):
         except:
             self._networkBlacklist = []
 
+        try:
+            self._maxDistance = float(self.commandline().optionString("max-distance"))
+        except:
+            pass
+        if self._maxDistance is not None and not self._evid:
+            print("--max-distance requires --event", file=sys.stderr)
+            return False
+
+        try:
+            self._batchSize = int(self.commandline().optionString("batch-size"))
+        except:
+            pass
+
+        try:
+            self._slice = float(self.commandline().optionString("slice"))
+        except:
+            pass
+        if self._slice <= 0:
+            print("Slice length must be positive", file=sys.stderr)
+            return False
+
+        self._cache = None
+        try:
+            cacheDir = self.commandline().optionString("cache-dir")
+        except:
+            cacheDir = None
+        if cacheDir:
+            try:
+                cacheSize = float(self.commandline().optionString("cache-size"))*1024*1024
+            except:
+                cacheSize = 1024*1024*1024
+            # the filter options and the database determine the content
+            try:
+                db = self.databaseURI()
+            except:
+                db = ""
+            key = "%s %s %s" % (db, self.commandline().hasOption("no-manual-picks"),
+                                " ".join(sorted(self._networkBlacklist)))
+            if self._maxDistance is not None:
+                key += " %s %g" % (self._evid, self._maxDistance)
+            self._cache = ShardCache(cacheDir, key, maxSize=cacheSize)
+
         return True
 
+    def _selectStations(self, org):
+        """
+        Select the stations within the maximum epicentral distance from
+        the origin that were operating at origin time. The inventory is
+        loaded once and all distances are computed at once.
+        """
+        t0 = org.time().value()
+        dbr = seiscomp.datamodel.DatabaseReader(self.database())
+        inv = seiscomp.datamodel.Inventory()
+        dbr.loadNetworks(inv)
+        codes, lats, lons = [], [], []
+        for inet in range(inv.networkCount()):
+            net = inv.network(inet)
+            dbr.loadStations(net)
+            for ista in range(net.stationCount()):
+                sta = net.station(ista)
+                try:
+                    if t0 < sta.start():
+                        continue
+                except ValueError:
+                    continue
+                try:
+                    if t0 > sta.end():
+                        continue
+                except ValueError:
+                    pass
+                codes.append( (net.code(), sta.code()) )
+                lats.append(sta.latitude())
+                lons.append(sta.longitude())
+
+        distances = sc3stuff.util.epicentral_distances(
+            org.latitude().value(), org.longitude().value(), lats, lons)
+        stations = set(code for code, delta in zip(codes, distances) if delta <= self._maxDistance)
+        seiscomp.logging.debug("%d of %d stations within %g degrees" % (len(stations), len(codes), self._maxDistance))
+        return stations
+
+    def _keepPick(self, pick):
+        if self._stations is None:
+            return True
+        wfid = pick.waveformID()
+        return (wfid.networkCode(), wfid.stationCode()) in self._stations
+
+    def _bytesSent(self):
+        # Number of bytes the database server has sent to us. This is
+        # only available for MySQL.
+        db = self.database()
+        try:
+            if not db.beginQuery("show session status like 'Bytes_sent'"):
+                return None
+            try:
+                if not db.fetchRow():
+                    return None
+                return int(db.getRowFieldString(1))
+            finally:
+                db.endQuery()
+        except Exception:
+            return None
+
+    def _measure(self, kind, query):
+        # Fetch all objects of a query, accounting for the time spent
+        # and the bytes received. query is a callable starting the query
+        # and returning the object iterator. It is only called after the
+        # byte count was read, as no other query can be run while a
+        # result set is open.
+        stats = self._queryStats[kind]
+        b0 = self._bytesSent()
+        t0 = time.time()
+        objs = list(query())
+        stats[0] += time.time() - t0
+        stats[1] += len(objs)
+        b1 = self._bytesSent()
+        if b0 is not None and b1 is not None:
+            stats[2] += b1 - b0
+        return objs
+
+    def _pickQuery(self, dbq, start, end):
+        # The pick filters are part of the query, so that rejected picks
+        # are never transferred.
+        col = dbq.convertColumnName
+        q = "select PPick.%s, Pick.* from Pick, PublicObject as PPick " \
+            "where Pick._oid=PPick._oid and Pick.%s >= '%s' and Pick.%s < '%s'" % (
+            col("publicID"), col("time_value"), start.toString("%F %T"),
+            col("time_value"), end.toString("%F %T"))
+        if self.commandline().hasOption("no-manual-picks"):
+            q += " and (Pick.%s is null or Pick.%s != 'manual')" % (col("evaluationMode"), col("evaluationMode"))
+        if self._networkBlacklist:
+            q += " and Pick.%s not in (%s)" % (col("waveformID_networkCode"),
+                 ",".join(sql_quote(net) for net in self._networkBlacklist))
+        if self._stations is not None and len(self._stations) <= 1000:
+            # Station codes are not unique across networks, so this is
+            # only a preselection refined by _keepPick().
+            q += " and Pick.%s in (%s)" % (col("waveformID_stationCode"),
+                 ",".join(sql_quote(sta) for sta in sorted(set(sta for net, sta in self._stations))) or "''")
+        return q
+
+    def _amplitudeQuery(self, dbq, pickIDs):
+        col = dbq.convertColumnName
+        return "select PAmplitude.%s, Amplitude.* from Amplitude, PublicObject as PAmplitude " \
+               "where Amplitude._oid=PAmplitude._oid and Amplitude.%s in (%s)" % (
+               col("publicID"), col("pickID"), ",".join(sql_quote(pickID) for pickID in pickIDs))
+
+    def _loadSlice(self, dbq, start, end, previous):
+        """
+        Load the picks and amplitudes of one time slice. Picks already
+        loaded with the previous slice, whose IDs are given, are skipped.
+        Returns the tuple of an EventParameters instance and the set of
+        the loaded pick IDs.
+
+        Only picks passing the filters are queried, and only the
+        amplitudes of these picks, in batches of pick IDs.
+        """
+        if self.commandline().hasOption("legacy-queries"):
+            return self._loadSliceLegacy(dbq, start, end, previous)
+
+        ep  = seiscomp.datamodel.EventParameters()
+        picks = []
+        for obj in self._measure("picks", lambda: dbq.getObjectIterator(
+                self._pickQuery(dbq, start, end), seiscomp.datamodel.Pick.TypeInfo())):
+            pick = seiscomp.datamodel.Pick.Cast(obj)
+            if pick and pick.publicID() not in previous and self._keepPick(pick):
+                picks.append(pick.publicID())
+                ep.add(pick)
+
+        for i in range(0, len(picks), self._batchSize):
+            q = self._amplitudeQuery(dbq, picks[i:i+self._batchSize])
+            for obj in self._measure("amplitudes", lambda: dbq.getObjectIterator(
+                    q, seiscomp.datamodel.Amplitude.TypeInfo())):
+                ampl = seiscomp.datamodel.Amplitude.Cast(obj)
+                if ampl:
+                    ep.add(ampl)
+
+        return ep, set(picks)
+
+    def _loadSliceLegacy(self, dbq, start, end, previous):
+        # All picks and amplitudes of the time slice are transferred and
+        # filtered here; amplitudes may lag behind their picks.
+        ep  = seiscomp.datamodel.EventParameters()
+        picks = set()
+        for obj in self._measure("picks", lambda: dbq.getPicks(start, end)):
+            pick = seiscomp.datamodel.Pick.Cast(obj)
+            if pick:
+                if pick.evaluationMode() == seiscomp.datamodel.MANUAL and self.commandline().hasOption("no-manual-picks"):
+                    continue
+                if pick.waveformID().networkCode() in self._networkBlacklist:
+                    continue
+                if pick.publicID() in previous:
+                    continue
+                if not self._keepPick(pick):
+                    continue
+                picks.add(pick.publicID())
+                ep.add(pick)
+
+        for obj in self._measure("amplitudes", lambda: dbq.getAmplitudes(start, end)):
+            ampl = seiscomp.datamodel.Amplitude.Cast(obj)
+            if ampl:
+                if not ampl.pickID():
+                    continue
+                if ampl.pickID() not in picks and ampl.pickID() not in previous:
+                    continue
+                ep.add(ampl)
+
+        return ep, picks
+
+    def _loadCached(self, dbq, start, end, previous):
+        """
+        Like _loadSlice() but using the cache, which holds whole shards.
+        The slice must not span more than one shard. Shards too recent
+        to be cached are not loaded as a whole, only the slice is.
+        """
+        shardStart = self._cache.shardStart(start)
+        shardEnd = shardStart + seiscomp.core.TimeSpan(self._cache.shardLength)
+        if not self._cache.cacheable(shardStart):
+            return self._loadSlice(dbq, start, end, previous)
+        ep = self._cache.load(shardStart)
+        if ep is None:
+            ep, picks = self._loadSlice(dbq, shardStart, shardEnd, set())
+            self._cache.store(shardStart, ep)
+
+        # remove the picks outside the slice or already loaded and their
+        # amplitudes
+        picks, removed = set(), set()
+        for i in reversed(range(ep.pickCount())):
+            pick = ep.pick(i)
+            t = pick.time().value()
+            if t < start or t >= end or pick.publicID() in previous:
+                removed.add(pick.publicID())
+                ep.removePick(i)
+            else:
+                picks.add(pick.publicID())
+        if removed:
+            for i in reversed(range(ep.amplitudeCount())):
+                if ep.amplitude(i).pickID() in removed:
+                    ep.removeAmplitude(i)
+        return ep, picks
+
     def run(self):
         if not self._processCommandLineOptions():
             return False
 
         dbq = self.query()
-        ep  = seiscomp.datamodel.EventParameters()
 
         # If we got an event ID as command-line argument...
         if self._evid:
@@ -96,13 +464,16 @@ class PickLoader(seiscomp.client.Application):
             if evt is None:
                 raise TypeError("unknown event '" + self._evid + "'")
             # If start time was not specified, compute it from origin time.
-            if self._startTime is None:
+            if self._startTime is None or self._maxDistance is not None:
                 orid = evt.preferredOriginID()
-                org = dbq.loadObject(seiscomp.datamodel.Origin.TypeInfo(), orid)
-                org = seiscomp.datamodel.Origin.Cast(org)
+                obj = dbq.loadObject(seiscomp.datamodel.Origin.TypeInfo(), orid)
+                org = seiscomp.datamodel.Origin.Cast(obj)
+            if self._startTime is None:
                 t0 = org.time().value()
                 self._startTime = t0 + seiscomp.core.TimeSpan(-self._before)
                 self._endTime   = t0 + seiscomp.core.TimeSpan( self._after)
+            if self._maxDistance is not None:
+                self._stations = self._selectStations(org)
 #               print("time window: %s ... %s" % (self._startTime, self._endTime), file=sys.stderr)
 
             if not self.commandline().hasOption("no-origins"):
@@ -114,29 +485,69 @@ class PickLoader(seiscomp.client.Application):
                         continue
                     self._orids.append(org.publicID())
 
-        picks = {}
-        for obj in dbq.getPicks(self._startTime, self._endTime):
-            pick = seiscomp.datamodel.Pick.Cast(obj)
-            if pick:
-                if pick.evaluationMode() == seiscomp.datamodel.MANUAL and self.commandline().hasOption("no-manual-picks"):
-                    continue
-                if pick.waveformID().networkCode() in self._networkBlacklist:
-                    continue
-                picks[pick.publicID()] = pick
-                ep.add(pick)
-        seiscomp.logging.debug("loaded %d picks" % ep.pickCount())
+        if self.commandline().hasOption("invalidate-cache"):
+            if self._cache is None:
+                print("No cache directory specified", file=sys.stderr)
+                return False
+            count = self._cache.invalidate(self._startTime, self._endTime)
+            print("removed %d cached shards" % count, file=sys.stderr)
+            return True
 
-        for obj in dbq.getAmplitudes(self._startTime, self._endTime):
-            ampl = seiscomp.datamodel.Amplitude.Cast(obj)
-            if ampl:
-                if not ampl.pickID():
-                    continue
-                if ampl.pickID() not in picks:
-                    continue
-                ep.add(ampl)
-        del picks
-        seiscomp.logging.debug("loaded %d amplitudes" % ep.amplitudeCount())
+        if self._startTime is None or self._endTime is None:
+            print("Need a time window or an event", file=sys.stderr)
+            return False
 
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        writer = sc3stuff.xmlstream.EventParametersWriter(out)
+
+        # Load and write the picks and amplitudes slice by slice, so
+        # that only one slice is held in memory.
+        previous = set()
+        pickCount = amplCount = 0
+        t0 = time.time()
+        total = float(self._endTime - self._startTime)
+        start = self._startTime
+        while start < self._endTime:
+            end = min(start + seiscomp.core.TimeSpan(self._slice), self._endTime)
+            if self._cache:
+                # With the cache the slices are the shards, except for
+                # recent shards, which are not cached. Slices never span
+                # more than one shard.
+                shardStart = self._cache.shardStart(start)
+                shardEnd = shardStart + seiscomp.core.TimeSpan(self._cache.shardLength)
+                if self._cache.cacheable(shardStart):
+                    end = min(shardEnd, self._endTime)
+                else:
+                    end = min(end, shardEnd)
+                ep, picks = self._loadCached(dbq, start, end, previous)
+            else:
+                ep, picks = self._loadSlice(dbq, start, end, previous)
+            writer.write(ep)
+            pickCount += ep.pickCount()
+            amplCount += ep.amplitudeCount()
+            del ep
+            # Picks at the boundary may be returned for both slices and
+            # amplitudes may lag behind their picks, so the pick IDs of
+            # the previous slice are kept.
+            previous = picks
+
+            dt = time.time() - t0
+            print("%s ... %s  %5.1f%%  %d picks  %d amplitudes  %.0f picks/s  %.1f MB written" % (
+                start.iso(), end.iso(), 100.*float(end - self._startTime)/total if total > 0 else 100.,
+                pickCount, amplCount, pickCount/dt if dt > 0 else 0., writer.bytesWritten/1048576.),
+                file=sys.stderr)
+            start = end
+        seiscomp.logging.debug("loaded %d picks" % pickCount)
+        seiscomp.logging.debug("loaded %d amplitudes" % amplCount)
+        for kind in [ "picks", "amplitudes" ]:
+            seconds, rows, nbytes = self._queryStats[kind]
+            print("%s queries: %.2f s  %d rows  %s" % (kind, seconds, rows,
+                "%.1f MB received" % (nbytes/1048576.) if nbytes else "bytes received unknown"),
+                file=sys.stderr)
+        if self._cache:
+            print("cache: %d shards loaded  %d queried" % (self._cache.hits, self._cache.misses), file=sys.stderr)
+
+        ep  = seiscomp.datamodel.EventParameters()
         if not self.commandline().hasOption("no-origins"):
             for i,orid in enumerate(self._orids):
                 # XXX There was occasionally a problem with:
@@ -151,12 +562,9 @@ class PickLoader(seiscomp.client.Application):
                 ep.add(org)
             seiscomp.logging.debug("loaded %d manual origins" % ep.originCount())
 
-        # finally dump event parameters as formatted XML archive to stdout
-        ar = seiscomp.io.XMLArchive()
-        ar.setFormattedOutput(True)
-        ar.create("-")
-        ar.writeObject(ep)
-        ar.close()
+        # finally the origins complete the XML document on stdout
+        writer.write(ep)
+        writer.close()
         del ep
         return True
 
@@ -1,5 +1,92 @@
-import sys, os, time, tempfile
+import sys, os, stat, time, threading
 import seiscomp.core, seiscomp.client, seiscomp.datamodel, seiscomp.io, seiscomp.logging
+import sc3stuff.scheduler, sc3stuff.util, sc3stuff.xmlstream
+from sc3stuff.scheduler import monotonic
+
+
+class ControlThread(threading.Thread):
+    """
+    Reads playback commands, one per line, from a file, typically a
+    named pipe, and applies them to a Scheduler:
+
+        pause
+        resume
+        speed <factor>      (0 means as fast as possible)
+        skip <YYYY-MM-DD HH:MM:SS>
+        stop
+
+    A named pipe is reopened at end of file so that commands can be
+    sent with e.g. 'echo pause > fifo' any number of times. A regular
+    file is polled every 'interval' seconds for appended lines, e.g.
+    from 'echo pause >> file'; lines already in it are ignored.
+    """
+
+    def __init__(self, filename, scheduler, seconds, interval=1.):
+        threading.Thread.__init__(self, name="control")
+        self.daemon = True
+        self._filename = filename
+        self._scheduler = scheduler
+        # converts a seiscomp.core.Time to the scheduler's data time
+        self._seconds = seconds
+        self._interval = interval
+
+    def _command(self, line):
+        words = line.split(None, 1)
+        if not words:
+            return
+        cmd, arg = words[0], words[1].strip() if len(words) > 1 else None
+        if cmd == "pause":
+            self._scheduler.pause()
+        elif cmd == "resume":
+            self._scheduler.resume()
+        elif cmd == "speed" and arg:
+            speed = float(arg)
+            self._scheduler.setSpeed(speed if speed > 0 else None)
+        elif cmd == "skip" and arg:
+            t = seiscomp.core.Time.GMT()
+            if not t.fromString(arg, "%F %T"):
+                raise ValueError("wrong time format '%s'" % arg)
+            self._scheduler.skip(self._seconds(t))
+        elif cmd == "stop":
+            self._scheduler.stop()
+        else:
+            raise ValueError("unknown command '%s'" % line.strip())
+        seiscomp.logging.info("control: %s" % line.strip())
+
+    def _apply(self, line):
+        try:
+            self._command(line)
+        except ValueError as e:
+            seiscomp.logging.error("control: %s" % str(e))
+
+    def _readPipe(self):
+        while not self._scheduler.stopped:
+            # blocks until there is a writer
+            with open(self._filename) as f:
+                for line in f:
+                    self._apply(line)
+
+    def _pollFile(self):
+        with open(self._filename) as f:
+            f.seek(0, os.SEEK_END)
+            partial = ""
+            while not self._scheduler.stopped:
+                line = f.readline()
+                if not line:
+                    time.sleep(self._interval)
+                    continue
+                partial += line
+                # a line may not have been written completely yet
+                if partial.endswith("\n"):
+                    self._apply(partial)
+                    partial = ""
+
+    def run(self):
+        if stat.S_ISFIFO(os.stat(self._filename).st_mode):
+            self._readPipe()
+        else:
+            self._pollFile()
+
 
 class PickPlayer(seiscomp.client.Application):
 
@@ -9,8 +96,13 @@ class PickPlayer(seiscomp.client.Application):
         self.setDatabaseEnabled(False, False)
         self.setPrimaryMessagingGroup("PICK")
         self._startTime = self._endTime = None
-        self._xmlFile = None
-        self._tmpDir = None
+        self._xmlFiles = []
+        self._bufferSize = 1024*1024
+        self._statsInterval = 60.
+        self._control = None
+        self._batchSize = 1
+        self._batchBytes = 512*1024
+        self._messages = 0
         self.speed = 1
 
     def createCommandLineDescription(self):
@@ -21,9 +113,13 @@ class PickPlayer(seiscomp.client.Application):
         self.commandline().addStringOption("Play", "begin", "specify start of time window")
         self.commandline().addStringOption("Play", "end", "specify end of time window")
         self.commandline().addStringOption("Play", "speed", "specify speed factor")
+        self.commandline().addStringOption("Play", "control", "read the commands pause, resume, speed, skip and stop from this file or named pipe")
+        self.commandline().addStringOption("Play", "batch-size", "maximum number of objects due at the same time to send in one message (default is 1)")
+        self.commandline().addStringOption("Play", "batch-kb", "approximate maximum size of a message in kB (default is 512)")
         self.commandline().addGroup("Input")
-        self.commandline().addStringOption("Input", "xml-file", "specify xml file")
-        self.commandline().addStringOption("Input", "tmp-dir", "specify tmp directory (default is /tmp)")
+        self.commandline().addStringOption("Input", "xml-file", "specify xml file(s), comma-separated, e.g. one per day")
+        self.commandline().addStringOption("Input", "buffer-size", "size of the read buffer in stream mode in kB (default is 1024)")
+        self.commandline().addStringOption("Input", "stats-interval", "interval in seconds at which the throughput and timing statistics are logged (default is 60)")
 
     def validateParameters(self):
         if not self.commandline().hasOption("test"):
@@ -42,10 +138,22 @@ class PickPlayer(seiscomp.client.Application):
         try:    end = self.commandline().optionString("end")
         except: end = None
 
-        try:    self._xmlFile = self.commandline().optionString("xml-file")
+        try:    self._xmlFiles = self.commandline().optionString("xml-file").split(",")
+        except: pass
+
+        try:    self._control = self.commandline().optionString("control")
+        except: pass
+
+        try:    self._batchSize = max(int(self.commandline().optionString("batch-size")), 1)
+        except: pass
+
+        try:    self._batchBytes = int(self.commandline().optionString("batch-kb"))*1024
+        except: pass
+
+        try:    self._bufferSize = int(self.commandline().optionString("buffer-size"))*1024
         except: pass
 
-        try:    self._tmpDir = self.commandline().optionString("tmp-dir")
+        try:    self._statsInterval = float(self.commandline().optionString("stats-interval"))
         except: pass
 
         try:
@@ -69,119 +177,152 @@ class PickPlayer(seiscomp.client.Application):
 
         return True
 
-    def _readEventParametersFromXML(self):
-        ar = seiscomp.io.XMLArchive()
-        if ar.open(self._xmlFile) == False:
-            raise IOError(self._xmlFile + ": unable to open")
-        obj = ar.readObject()
-        if obj is None:
-            raise TypeError(self._xmlFile + ": invalid format")
-        ep  = seiscomp.datamodel.EventParameters.Cast(obj)
-        if ep is None:
-            raise TypeError(self._xmlFile + ": no eventparameters found")
-        return ep
+    def _send(self, ep, objs):
+        # All objects are sent in one NotifierMessage
+        seiscomp.datamodel.Notifier.Enable()
+        for obj in objs:
+            ep.add(obj)
+        msg = seiscomp.datamodel.Notifier.GetMessage()
+        if self.commandline().hasOption("test"):
+            for obj in objs:
+                sys.stderr.write("Test mode - not sending %-10s %s\n" % (obj.ClassName(), obj.publicID()))
+        else:
+            if self.connection().send(msg):
+                for obj in objs:
+                    sys.stderr.write("Sent %s %s\n" % (obj.ClassName(), obj.publicID()))
+            else:
+                for obj in objs:
+                    sys.stderr.write("Failed to send %-10s %s\n" % (obj.ClassName(), obj.publicID()))
+        seiscomp.datamodel.Notifier.Disable()
+        # don't accumulate the sent objects
+        for obj in objs:
+            ep.remove(obj)
+        self._messages += 1
+        self.sync()
+
+    @staticmethod
+    def _estimatedSize(obj):
+        # Rough size of the serialized object in bytes. Exact sizes
+        # would require serializing every object twice.
+        org = seiscomp.datamodel.Origin.Cast(obj)
+        if org is None:
+            return 1000
+        size = 2000 + 400*(org.arrivalCount() + org.stationMagnitudeCount())
+        for i in range(org.magnitudeCount()):
+            size += 500 + 200*org.magnitude(i).stationMagnitudeContributionCount()
+        return size
+
+    def _logRates(self, label, stats, messages):
+        dt = monotonic() - stats.wallStart
+        seiscomp.logging.info("%s: %s  %d messages  %.1f messages/s" % (
+            label, stats, messages, messages / dt if dt > 0 else 0.))
 
     def _runBatchMode(self):
-        ep = self._readEventParametersFromXML()
-
-        # collect the objects
-        objs = []
-        while ep.pickCount() > 0:
-            # FIXME: The cast hack forces the SC3 refcounter to be increased.
-            pick = seiscomp.datamodel.Pick.Cast(ep.pick(0))
-            ep.removePick(0)
-            objs.append(pick)
-        while ep.amplitudeCount() > 0:
-            # FIXME: The cast hack forces the SC3 refcounter to be increased.
-            ampl = seiscomp.datamodel.Amplitude.Cast(ep.amplitude(0))
-            ep.removeAmplitude(0)
-            objs.append(ampl)
-        while ep.originCount() > 0:
-            # FIXME: The cast hack forces the SC3 refcounter to be increased.
-            origin = seiscomp.datamodel.Origin.Cast(ep.origin(0))
-            ep.removeOrigin(0)
-            objs.append(origin)
-        del ep
-
-        # DSU sort all objects by object creation time
-        sortlist = []
-        for obj in objs:
-            # discard objects that have no creationInfo attribute
-            try:    t = obj.creationInfo().creationTime()
-            except: continue
+        # The input files are merged lazily in creation time order
+        merger = sc3stuff.xmlstream.mergeFiles(self._xmlFiles, self._startTime, self._endTime)
+        objects = iter(merger)
+        pending = next(objects, None)
+        if pending is None:
+            return True
+        time_of_1st_object, obj = pending
+
+        def seconds(t):
+            # data time relative to the first object
+            return float(t - time_of_1st_object)
+
+        scheduler = sc3stuff.scheduler.Scheduler(self.speed)
+        if self._control:
+            ControlThread(self._control, scheduler, seconds).start()
 
-            if self._startTime is not None and t < self._startTime:
-                continue
-            if self._endTime is not None and t > self._endTime:
-                continue
-            sortlist.append( (t,obj) )
-        sortlist.sort()
+        ep = seiscomp.datamodel.EventParameters()
+
+        # go through the sorted objects and process them sequentially
+        messages = self._messages
+        while pending is not None:
+            if self.isExitRequested() or scheduler.stopped: break
+
+            # The delay of the actual send compared to the scheduled
+            # time is recorded after sending. Objects skipped over are
+            # sent right away and not accounted for.
+            t, obj = pending
+            lag = scheduler.wait(seconds(t), record=False)
+            if scheduler.stopped: break
+
+            # Together with the first object, send all following objects
+            # that are due already, in order and within the limits.
+            batch = [ (t, obj, lag) ]
+            size = self._estimatedSize(obj)
+            pending = next(objects, None)
+            while pending is not None and len(batch) < self._batchSize:
+                t, obj = pending
+                size += self._estimatedSize(obj)
+                if size > self._batchBytes or not scheduler.ready(seconds(t)):
+                    break
+                batch.append( (t, obj, scheduler.wait(seconds(t), record=False)) )
+                pending = next(objects, None)
+
+            self._send(ep, [ obj for (t, obj, lag) in batch ])
+            for t, obj, lag in batch:
+                if lag is None:
+                    continue
+                delay = scheduler.record(seconds(t))
+                seiscomp.logging.debug("%s %s scheduled %s delay %.1f ms" % (
+                    obj.ClassName(), obj.publicID(), t.iso(), delay*1000))
+
+            if monotonic() - scheduler.interval.wallStart >= self._statsInterval:
+                self._logRates("playback", scheduler.interval, self._messages - messages)
+                messages = self._messages
+                scheduler.resetInterval()
+
+        self._logRates("playback total", scheduler.total, self._messages)
+        if merger.duplicates:
+            seiscomp.logging.info("dropped %d duplicate objects" % merger.duplicates)
+        scheduler.stop()
+        return True
 
-        time_of_1st_object, obj = sortlist[0]
-        time_of_playback_start = seiscomp.core.Time.GMT()
 
+    def _runStreamMode(self, stream=sys.stdin):
+        # Objects are parsed directly from the input as soon as they
+        # are complete and sent right away.
+        stream = getattr(stream, "buffer", stream)
         ep = seiscomp.datamodel.EventParameters()
-        pickampl = {}
 
-        # go through the sorted list of object and process them sequentially
-        for t,obj in sortlist:
+        count = intervalCount = 0
+        startTime = intervalTime = monotonic()
+        for obj in sc3stuff.xmlstream.readObjects(stream, self._bufferSize):
             if self.isExitRequested(): return
 
-            if self.speed:
-                t = time_of_playback_start + seiscomp.core.TimeSpan(float(t - time_of_1st_object) / self.speed)
-                while t > seiscomp.core.Time.GMT():
-                    time.sleep(0.1)
-
-            if obj.ClassName() not in [ "Pick", "Amplitude", "Origin" ]:
+            try:    t = obj.creationInfo().creationTime()
+            except: continue
+            if self._startTime is not None and t < self._startTime:
+                continue
+            if self._endTime is not None and t > self._endTime:
                 continue
 
-            seiscomp.datamodel.Notifier.Enable()
-            ep.add(obj)
-            msg = seiscomp.datamodel.Notifier.GetMessage()
-            if self.commandline().hasOption("test"):
-                sys.stderr.write("Test mode - not sending %-10s %s\n" % (obj.ClassName(), obj.publicID()))
-            else:
-                if self.connection().send(msg):
-                    sys.stderr.write("Sent %s %s\n" % (obj.ClassName(), obj.publicID()))
-                else:
-                    sys.stderr.write("Failed to send %-10s %s\n" % (obj.ClassName(), obj.publicID()))
-            seiscomp.datamodel.Notifier.Disable()
-            self.sync()
-
-        return True
-
+            self._send(ep, [ obj ])
 
-    def _runStreamMode(self, stream=sys.stdin):
+            count += 1
+            intervalCount += 1
+            now = monotonic()
+            if now - intervalTime >= self._statsInterval:
+                seiscomp.logging.info("stream: %d objects  %.1f objects/s" % (
+                    count, intervalCount / (now - intervalTime)))
+                intervalCount, intervalTime = 0, now
 
-        import xml.dom.pulldom
-        events = xml.dom.pulldom.parse(stream, bufsize=100)
-        for event in events:
-            typ, node = event
-            if typ == 'START_ELEMENT' and node.nodeName in ["pick","amplitude","origin"]:
-                events.expandNode(node)
-                xmlNode = node.toxml()
-                ofile = open(self._xmlFile, "w")
-                # wrap object into a SC3 XML template
-                ofile.write('<?xml version="1.0" encoding="UTF-8"?><seiscomp xmlns="http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.7" version="0.7"><EventParameters>%s</EventParameters></seiscomp>\n' % xmlNode)
-                ofile.close()
-                # in batch mode pick up data in temp file
-                self._runBatchMode()
+        dt = monotonic() - startTime
+        seiscomp.logging.info("stream total: %d objects in %.1f s  %.1f objects/s" % (
+            count, dt, count / dt if dt > 0 else 0.))
         return True
 
     def run(self):
 
-        if self._xmlFile:
+        if self._xmlFiles:
             seiscomp.logging.debug("running in batch mode")
-            seiscomp.logging.debug("input file is %s" % self._xmlFile)
+            seiscomp.logging.debug("input files are %s" % " ".join(self._xmlFiles))
             return self._runBatchMode()
 
-        self._xmlFile = tempfile.mktemp(".xml", dir=self._tmpDir)
         seiscomp.logging.debug("running in stream mode")
-        seiscomp.logging.debug("temp file is %s" % self._xmlFile)
-        status = self._runStreamMode()
-        if os.path.exists(self._xmlFile):
-            os.unlink(self._xmlFile)
-        return status
+        return self._runStreamMode()
 
 
 
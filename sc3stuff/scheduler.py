@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+import time, math, threading
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2
+    monotonic = time.time
+
+
+class Statistics(object):
+    """
+    Lag and throughput statistics of a Scheduler.
+
+    The lag is the delay of the actual release of an object compared
+    to its scheduled time, the jitter the standard deviation of the
+    lag.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lagSum = 0.
+        self.lagSquareSum = 0.
+        self.lagMax = 0.
+        self.wallStart = monotonic()
+        self.dataStart = self.dataEnd = None
+
+    def add(self, t, lag):
+        self.count += 1
+        self.lagSum += lag
+        self.lagSquareSum += lag*lag
+        self.lagMax = max(self.lagMax, lag)
+        if self.dataStart is None:
+            self.dataStart = t
+        self.dataEnd = t
+
+    def lag(self):
+        if not self.count:
+            return 0.
+        return self.lagSum / self.count
+
+    def jitter(self):
+        if not self.count:
+            return 0.
+        mean = self.lag()
+        return math.sqrt(max(self.lagSquareSum / self.count - mean*mean, 0.))
+
+    def rate(self):
+        dt = monotonic() - self.wallStart
+        return self.count / dt if dt > 0 else 0.
+
+    def speed(self):
+        """
+        Achieved speed factor, i.e. data time span per wall time
+        """
+        dt = monotonic() - self.wallStart
+        if self.dataStart is None or dt <= 0:
+            return 0.
+        return (self.dataEnd - self.dataStart) / dt
+
+    def __str__(self):
+        return "%d objects  %.1f objects/s  speed %.2f  lag %.4f s (max %.4f s)  jitter %.4f s" % (
+            self.count, self.rate(), self.speed(), self.lag(), self.lagMax, self.jitter())
+
+
+class Scheduler(object):
+    """
+    Releases objects at the times they are due, based on their data
+    times (e.g. creation or reception times) in seconds and a speed
+    factor. The first object is released immediately, each following
+    one when the data time elapsed since the first object, divided by
+    the speed factor, has elapsed on the monotonic clock. If the speed
+    factor is None, objects are released as fast as possible.
+
+    wait() sleeps until an object is due rather than polling the clock.
+    Playback can be paused and resumed, the speed changed and playback
+    skipped ahead to a data time at any time, typically from another
+    thread. A waiting call to wait() is woken up by each such change
+    and recomputes when its object is due.
+
+    Statistics are accumulated for the whole run ('total') and for
+    the interval since the last call to resetInterval() ('interval').
+    """
+
+    def __init__(self, speed=1.):
+        self.speed = speed
+        self.paused = False
+        self.stopped = False
+        # data time corresponding to a wall clock time (monotonic)
+        self._dataAnchor = None
+        self._wallAnchor = None
+        self._pausedAt = None
+        self._skipTo = None
+        self._last = None
+        self._cond = threading.Condition()
+        self.total = Statistics()
+        self.interval = Statistics()
+
+    def _anchor(self, t):
+        self._dataAnchor, self._wallAnchor = t, monotonic()
+
+    def position(self):
+        """
+        Current data time of the playback or None if playback has not
+        started yet
+        """
+        with self._cond:
+            if self._dataAnchor is None:
+                return None
+            if self.paused:
+                return self._pausedAt
+            if not self.speed:
+                return self._last
+            return self._dataAnchor + (monotonic() - self._wallAnchor) * self.speed
+
+    def due(self, t):
+        """
+        Wall clock time (monotonic) at which data time t is due
+        """
+        if self._dataAnchor is None:
+            self._anchor(t)
+        if not self.speed:
+            return self._wallAnchor
+        return self._wallAnchor + (t - self._dataAnchor) / self.speed
+
+    def setSpeed(self, speed):
+        """
+        Change the speed factor, continuing from the current position
+        """
+        with self._cond:
+            t = self.position()
+            self.speed = speed
+            if t is not None and not self.paused:
+                self._anchor(t)
+            self._cond.notify_all()
+
+    def pause(self):
+        with self._cond:
+            if not self.paused:
+                self._pausedAt = self.position()
+                self.paused = True
+            self._cond.notify_all()
+
+    def resume(self):
+        with self._cond:
+            if self.paused:
+                self.paused = False
+                if self._pausedAt is not None:
+                    self._anchor(self._pausedAt)
+            self._cond.notify_all()
+
+    def skip(self, t):
+        """
+        Continue playback at data time t. Objects earlier than t are
+        released immediately; for these wait() returns None.
+        """
+        with self._cond:
+            self._skipTo = t
+            if self.paused:
+                self._pausedAt = t
+            else:
+                self._anchor(t)
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+        Stop playback. A waiting or any further call to wait() returns
+        None immediately.
+        """
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def ready(self, t):
+        """
+        True if wait(t) would return without sleeping
+        """
+        with self._cond:
+            if self.stopped:
+                return True
+            if self.paused:
+                return False
+            if self._skipTo is not None and t < self._skipTo:
+                return True
+            return not self.speed or self.due(t) <= monotonic()
+
+    def wait(self, t, record=True):
+        """
+        Sleep until data time t is due. Returns the lag in seconds,
+        which is also added to the statistics unless record is False.
+        In that case the caller may pass the object on first and then
+        call record() to account for the actual delay.
+        """
+        with self._cond:
+            while True:
+                if self.stopped:
+                    return None
+                if self.paused:
+                    self._cond.wait()
+                    continue
+                if self._skipTo is not None:
+                    if t < self._skipTo:
+                        self._last = t
+                        return None
+                    self._skipTo = None
+                due = self.due(t)
+                if not self.speed:
+                    break
+                remaining = due - monotonic()
+                if remaining <= 0:
+                    break
+                # NOTE: In Python 2 a wait with timeout is implemented
+                # by polling, in Python 3 it is a plain timed wait.
+                self._cond.wait(remaining)
+            self._last = t
+        if record:
+            return self.record(t)
+        return self.lag(t)
+
+    def lag(self, t):
+        """
+        Delay of the present time compared to the time at which data
+        time t is due
+        """
+        if not self.speed:
+            return 0.
+        return monotonic() - self.due(t)
+
+    def record(self, t):
+        """
+        Add the present lag of data time t to the statistics
+        """
+        lag = self.lag(t)
+        self.total.add(t, lag)
+        self.interval.add(t, lag)
+        return lag
+
+    def resetInterval(self):
+        self.interval = Statistics()
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import math
 import seiscomp.core, seiscomp.datamodel, seiscomp.io
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def readEventParametersFromXML(xmlFile="-"):
     """
     Reads an EventParameters root element from a SC3 XML file. The
@@ -61,76 +67,111 @@ def EventParametersFocalMechanisms(ep):
             yield obj
 
 
-def extractEventParameters(ep, eventID=None, filterOrigins=False, filterPicks=False):
+_eventParametersChildren = {
+    "Event":          ("eventCount",          "event",          "removeEvent"),
+    "Origin":         ("originCount",         "origin",         "removeOrigin"),
+    "Pick":           ("pickCount",           "pick",           "removePick"),
+    "Amplitude":      ("amplitudeCount",      "amplitude",      "removeAmplitude"),
+    "FocalMechanism": ("focalMechanismCount", "focalMechanism", "removeFocalMechanism"),
+}
+
+def detachChildren(ep, cls):
+    """
+    Remove all children of class cls (e.g. seiscomp.datamodel.Pick)
+    from an EventParameters instance and return them as a list, in
+    their original order. The caller takes ownership of the objects.
+
+    The children are removed from the back, which takes constant time
+    per child. Removing them from the front, as in
+
+        while ep.pickCount() > 0:
+            pick = seiscomp.datamodel.Pick.Cast(ep.pick(0))
+            ep.removePick(0)
+
+    shifts all remaining children each time and is quadratic in their
+    number.
+
+    About the cast hack: The object returned by e.g. ep.pick(i) is a
+    plain pointer that does not hold a reference. Once the child is
+    removed, the EventParameters drops its reference and the object
+    is deleted, leaving the Python object dangling. Cast() returns a
+    Python object holding a smart pointer, i.e. a reference, which
+    keeps the child alive after it has been removed.
+    """
+    count, get, remove = [ getattr(ep, name) for name in _eventParametersChildren[cls.ClassName()] ]
+    objs = []
+    for i in reversed(range(count())):
+        # FIXME: The cast hack forces the SC3 refcounter to be increased.
+        objs.append(cls.Cast(get(i)))
+        remove(i)
+    objs.reverse()
+    return objs
+
+
+def extractEventParameters(ep, eventID=None, filterOrigins=False, filterPicks=False, keepUnselected=False):
     """
     Extract picks, amplitudes, origins, events and focal mechanisms
     from an EventParameters instance. 
 
-    NOTE than the EventParameters is modified; extracted objects are removed.
+    NOTE that the EventParameters is emptied by the call; all objects
+    are removed from it and only the extracted ones are kept alive.
+    With keepUnselected=True, the objects not extracted are added back
+    in their original order instead, so that only the extracted ones
+    are removed, as in earlier versions.
     """
     pick  = {}
     ampl  = {}
     event = {}
     origin = {}
     fm = {}
+    # objects not extracted, to be added back with keepUnselected
+    unselected = []
 
-#   while ep.eventCount() > 0:
-#       # FIXME: The cast hack forces the SC3 refcounter to be increased.
-#       obj = seiscomp.datamodel.Event.Cast(ep.event(0))
-#       ep.removeEvent(0)
-    for obj in EventParametersEvents(ep):
+    for obj in detachChildren(ep, seiscomp.datamodel.Event):
         publicID = obj.publicID()
         if eventID is not None and publicID != eventID:
+            unselected.append(obj)
             continue
         event[publicID] = obj
 
-    pickIDs = []
-#   while ep.originCount() > 0:
-#       # FIXME: The cast hack forces the SC3 refcounter to be increased.
-#       obj = seiscomp.datamodel.Origin.Cast(ep.origin(0))
-#       ep.removeOrigin(0)
-    for obj in EventParametersOrigins(ep):
+    preferredOriginIDs = set(evt.preferredOriginID() for evt in event.values())
+    pickIDs = set()
+    for obj in detachChildren(ep, seiscomp.datamodel.Origin):
         publicID = obj.publicID()
         if filterOrigins:
             # only keep origins that are preferredOrigin's of an event
-            for _eventID in event:
-                if publicID == event[_eventID].preferredOriginID():
-                    origin[publicID] = org = obj
-                    # collect pick ID's for all associated picks
-                    for i in range(org.arrivalCount()):
-                        arr = org.arrival(i)
-                        pickIDs.append(arr.pickID())
-                    break
+            if publicID in preferredOriginIDs:
+                origin[publicID] = org = obj
+                # collect pick ID's for all associated picks
+                for i in range(org.arrivalCount()):
+                    arr = org.arrival(i)
+                    pickIDs.add(arr.pickID())
+            else:
+                unselected.append(obj)
 
         else:
             origin[publicID] = obj
 
-#   while ep.pickCount() > 0:
-#       # FIXME: The cast hack forces the SC3 refcounter to be increased.
-#       obj = seiscomp.datamodel.Pick.Cast(ep.pick(0))
-#       ep.removePick(0)
-    for obj in EventParametersPicks(ep):
+    for obj in detachChildren(ep, seiscomp.datamodel.Pick):
         publicID = obj.publicID()
         if filterPicks and publicID not in pickIDs:
+            unselected.append(obj)
             continue
         pick[publicID] = obj
 
-#   while ep.amplitudeCount() > 0:
-#       # FIXME: The cast hack forces the SC3 refcounter to be increased.
-#       obj = seiscomp.datamodel.Amplitude.Cast(ep.amplitude(0))
-#       ep.removeAmplitude(0)
-    for obj in EventParametersAmplitudes(ep):
+    for obj in detachChildren(ep, seiscomp.datamodel.Amplitude):
         if obj.pickID() not in pick:
+            unselected.append(obj)
             continue
         ampl[obj.publicID()] = obj
 
-#   while ep.focalMechanismCount() > 0:
-#       # FIXME: The cast hack forces the SC3 refcounter to be increased.
-#       obj = seiscomp.datamodel.FocalMechanism.Cast(ep.focalMechanism(0))
-#       ep.removeFocalMechanism(0)
-    for obj in EventParametersFocalMechanisms(ep):
+    for obj in detachChildren(ep, seiscomp.datamodel.FocalMechanism):
         fm[obj.publicID()] = obj
 
+    if keepUnselected:
+        for obj in unselected:
+            ep.add(obj)
+
     return event, origin, pick, ampl, fm
 
 
@@ -225,6 +266,28 @@ def nslc(wfid):
     return n,s,l,c
 
 
+def epicentral_distances(lat, lon, lats, lons):
+    """
+    Epicentral distances in degrees between one point and the points
+    given by the sequences lats and lons, e.g. an epicenter and all
+    stations. Uses numpy to compute all distances at once if it is
+    available.
+    """
+    if numpy is not None:
+        lat1, lon1 = numpy.radians(lat), numpy.radians(lon)
+        lat2, lon2 = numpy.radians(numpy.asarray(lats, dtype=float)), numpy.radians(numpy.asarray(lons, dtype=float))
+        h = numpy.sin((lat2-lat1)/2)**2 + numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin((lon2-lon1)/2)**2
+        return numpy.degrees(2*numpy.arcsin(numpy.sqrt(numpy.clip(h, 0., 1.))))
+
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    distances = []
+    for lat2, lon2 in zip(lats, lons):
+        lat2, lon2 = math.radians(lat2), math.radians(lon2)
+        h = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+        distances.append(math.degrees(2*math.asin(math.sqrt(min(max(h, 0.), 1.)))))
+    return distances
+
+
 def format_nslc_spaces(wfid):
     """
     Convenience function to return network, station, location and channel code as fixed-length, space-separated string
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming input and output of SC3 XML documents
+
+The whole document is never held in memory. Instead the raw XML of
+the selected elements (by default picks, amplitudes and origins) is
+cut out of the input as it arrives and all elements that became
+complete with one read are parsed into datamodel objects in one go.
+"""
+
+import heapq, collections
+from io import BytesIO
+import xml.parsers.expat
+from xml.sax.saxutils import quoteattr
+import seiscomp.datamodel, seiscomp.io, seiscomp.utils
+import sc3stuff.util
+
+
+class ElementSplitter(object):
+    """
+    Incrementally splits an XML document into the raw XML of the
+    elements with the given names. The elements are located using the
+    byte offsets reported by expat, so they are never rebuilt from a
+    DOM. Only the part of the input belonging to an incomplete element
+    is buffered.
+    """
+
+    def __init__(self, names=("pick", "amplitude", "origin")):
+        self._names = set(names)
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.StartElementHandler = self._startElement
+        self._parser.EndElementHandler = self._endElement
+        self._buf = bytearray()
+        # absolute input offset of the first byte in _buf
+        self._base = 0
+        # input offset of the last tag reported by expat
+        self._mark = 0
+        self._start = None
+        self._current = None
+        # nesting depth of elements named like the current one, e.g.
+        # the amplitude value inside an amplitude
+        self._depth = 0
+        self._elements = []
+        # start tag of the root element including the namespace
+        self.root = None
+
+    def _startElement(self, name, attrs):
+        self._mark = self._parser.CurrentByteIndex
+        if self.root is None:
+            self.root = "<%s%s>" % (name, "".join(
+                " %s=%s" % (k, quoteattr(v)) for k, v in sorted(attrs.items())))
+            self.root = self.root.encode("utf-8")
+            return
+        if self._start is None:
+            if name in self._names:
+                self._start = self._parser.CurrentByteIndex
+                self._current = (name, attrs.get("publicID"))
+                self._depth = 1
+        elif name == self._current[0]:
+            self._depth += 1
+
+    def _endElement(self, name):
+        self._mark = self._parser.CurrentByteIndex
+        if self._start is None or name != self._current[0]:
+            return
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        pos = self._parser.CurrentByteIndex
+        # CurrentByteIndex points at the start of the end tag
+        end = self._buf.index(b">", pos - self._base) + 1
+        data = bytes(self._buf[self._start - self._base:end])
+        self._elements.append(self._current + (data,))
+        self._start = self._current = None
+
+    def feed(self, data):
+        """
+        Feed the next chunk of input. Returns the list of elements that
+        were completed by it as tuples (name, publicID, xml).
+        """
+        self._buf.extend(data)
+        self._parser.Parse(data, False)
+        # Keep the beginning of an incomplete element. Otherwise keep
+        # everything from the last reported tag on, as expat may have
+        # consumed the beginning of a start tag without reporting it.
+        keep = self._start if self._start is not None else self._mark
+        del self._buf[:keep - self._base]
+        self._base = keep
+        elements, self._elements = self._elements, []
+        return elements
+
+    def close(self):
+        self._parser.Parse(b"", True)
+
+
+def parseElements(root, elements):
+    """
+    Parse the raw XML of a list of elements as returned by
+    ElementSplitter.feed() into datamodel objects. The elements are
+    wrapped into a single document so that the SC3 XML parser is only
+    invoked once per batch. The objects are returned in input order.
+    """
+    doc = root + b"<EventParameters>" + b"".join(e[2] for e in elements) + \
+          b"</EventParameters></" + root[1:].split(None, 1)[0].rstrip(b">") + b">"
+    ar = seiscomp.io.XMLArchive(seiscomp.utils.stringToStreambuf(doc))
+    ep = seiscomp.datamodel.EventParameters.Cast(ar.readObject())
+    ar.close()
+    if ep is None:
+        raise TypeError("no eventparameters found")
+
+    objects = {}
+    for cls in [ seiscomp.datamodel.Pick, seiscomp.datamodel.Amplitude, seiscomp.datamodel.Origin ]:
+        for obj in sc3stuff.util.detachChildren(ep, cls):
+            objects[obj.publicID()] = obj
+    return [ objects[publicID] for name, publicID, data in elements if publicID in objects ]
+
+
+def readObjects(f, bufferSize=1024*1024, names=("pick", "amplitude", "origin")):
+    """
+    Read a SC3 XML document from the binary file object f and yield
+    the picks, amplitudes and origins as soon as they are complete.
+
+    Input is read in chunks of up to bufferSize bytes. If available,
+    read1() is used so that a live feed, e.g. on stdin, is not delayed
+    until a whole buffer has been filled.
+    """
+    read = getattr(f, "read1", f.read)
+    splitter = ElementSplitter(names)
+    while True:
+        data = read(bufferSize)
+        if not data:
+            break
+        elements = splitter.feed(data)
+        if elements:
+            for obj in parseElements(splitter.root, elements):
+                yield obj
+    splitter.close()
+
+
+def _normalizeTime(s):
+    # Make an XML time string comparable as string, i.e. always with
+    # six fractional digits
+    s = s.strip().rstrip("Z")
+    if "." not in s:
+        s += "."
+    head, frac = s.split(".", 1)
+    return "%s.%sZ" % (head, (frac + "000000")[:6])
+
+
+def creationTimeRange(filename, names=("pick", "amplitude", "origin")):
+    """
+    Scan an XML file for the earliest and latest creation times of the
+    selected elements without creating any objects. Returns the tuple
+    (first, last) of normalized time strings or None if there are no
+    such elements with a creation time.
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    stack = []
+    text = []
+    times = [ None, None ]
+
+    def startElement(name, attrs):
+        stack.append(name)
+        del text[:]
+
+    def endElement(name):
+        if name == "creationTime" and len(stack) >= 3 and \
+           stack[-2] == "creationInfo" and stack[-3] in names:
+            t = _normalizeTime("".join(text))
+            if times[0] is None or t < times[0]:
+                times[0] = t
+            if times[1] is None or t > times[1]:
+                times[1] = t
+        stack.pop()
+
+    def characters(data):
+        text.append(data)
+
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characters
+    with open(filename, "rb") as f:
+        parser.ParseFile(f)
+    if times[0] is None:
+        return None
+    return tuple(times)
+
+
+def _formatTime(t):
+    return "%s.%06dZ" % (t.toString("%FT%T"), t.microseconds())
+
+
+def _seconds(t):
+    return t.seconds() + 1.e-6*t.microseconds()
+
+
+def readSorted(filename, startTime=None, endTime=None):
+    """
+    Read the picks, amplitudes and origins from an XML file and return
+    them as list of (creationTime, object) sorted by creation time.
+    Objects without creation time or outside the optional time window
+    are discarded. The sort is stable, so that objects with equal
+    creation times, like a pick and its amplitude, keep their order.
+    """
+    objs = []
+    with open(filename, "rb") as f:
+        for obj in readObjects(f):
+            # discard objects that have no creationInfo attribute
+            try:    t = obj.creationInfo().creationTime()
+            except: continue
+
+            if startTime is not None and t < startTime:
+                continue
+            if endTime is not None and t > endTime:
+                continue
+            objs.append( (t, obj) )
+    objs.sort(key=lambda item: item[0])
+    return objs
+
+
+class ObjectMerger(object):
+    """
+    Iterates over the picks, amplitudes and origins of several XML
+    files in creation time order, see mergeFiles().
+
+    Each file is only read once the merge has reached the earliest
+    creation time in it, so that only files overlapping in time are
+    held in memory together, e.g. only one of a series of daily files.
+    Files entirely outside the time window are never read.
+
+    An object with the same publicID as an object yielded within the
+    last 'window' seconds of creation time is considered a duplicate
+    and dropped. The number of dropped objects is counted in
+    'duplicates'.
+    """
+
+    def __init__(self, filenames, startTime=None, endTime=None, window=60.):
+        self._startTime = startTime
+        self._endTime = endTime
+        self._window = window
+        start = _formatTime(startTime) if startTime is not None else None
+        end = _formatTime(endTime) if endTime is not None else None
+        # files overlapping the time window sorted by their earliest
+        # creation time
+        self._files = []
+        for filename in filenames:
+            timeRange = creationTimeRange(filename)
+            if timeRange is None:
+                continue
+            first, last = timeRange
+            if (start is not None and last < start) or (end is not None and first > end):
+                continue
+            self._files.append( (first, last, filename) )
+        self._files.sort(reverse=True)
+        self._heap = []
+        self._seq = 0
+        self._recent = collections.deque()
+        self._recentIDs = set()
+        self.duplicates = 0
+
+    def _push(self, objs):
+        # objs is a sorted list; the heap holds the next object of each
+        # open file together with the rest of the file
+        if objs:
+            t, obj = objs[0]
+            self._seq += 1
+            heapq.heappush(self._heap, (t, self._seq, obj, objs, 1))
+
+    def _open(self):
+        first, last, filename = self._files.pop()
+        self._push(readSorted(filename, self._startTime, self._endTime))
+
+    def __iter__(self):
+        while True:
+            # open all files starting not later than the next object
+            while self._files and (not self._heap or
+                    self._files[-1][0] <= _formatTime(self._heap[0][0])):
+                self._open()
+            if not self._heap:
+                return
+
+            t, seq, obj, objs, i = heapq.heappop(self._heap)
+            # release the object once it has been passed on
+            objs[i-1] = None
+            if i < len(objs):
+                self._seq += 1
+                heapq.heappush(self._heap, (objs[i][0], self._seq, objs[i][1], objs, i+1))
+
+            now = _seconds(t)
+            while self._recent and self._recent[0][0] < now - self._window:
+                self._recentIDs.discard(self._recent.popleft()[1])
+            publicID = obj.publicID()
+            if publicID in self._recentIDs:
+                self.duplicates += 1
+                continue
+            self._recent.append( (now, publicID) )
+            self._recentIDs.add(publicID)
+
+            yield t, obj
+
+
+def mergeFiles(filenames, startTime=None, endTime=None, window=60.):
+    """
+    Merge the picks, amplitudes and origins of several XML files in
+    creation time order. Returns an iterable ObjectMerger yielding
+    (creationTime, object) tuples.
+    """
+    return ObjectMerger(filenames, startTime, endTime, window)
+
+
+class EventParametersWriter(object):
+    """
+    Writes the children of a series of EventParameters instances into
+    a single SC3 XML document on the binary file object f, so that a
+    large document can be written slice by slice. Each call to write()
+    serializes one EventParameters instance and writes its children
+    right away; close() completes the document.
+    """
+
+    class Sink(seiscomp.io.ExportSink):
+
+        def __init__(self, buf):
+            seiscomp.io.ExportSink.__init__(self)
+            self.buf = buf
+
+        def write(self, data, size):
+            self.buf.write(data[:size])
+            return size
+
+    def __init__(self, f, formatted=True, expName="trunk"):
+        self._f = f
+        self._exp = seiscomp.io.Exporter.Create(expName)
+        if not self._exp:
+            raise ValueError("exporter '%s' not found" % expName)
+        self._exp.setFormattedOutput(formatted)
+        self._buf = BytesIO()
+        self._sink = self.Sink(self._buf)
+        self._footer = None
+        self.bytesWritten = 0
+
+    def _write(self, data):
+        self._f.write(data)
+        self.bytesWritten += len(data)
+
+    def write(self, ep):
+        self._buf.seek(0)
+        self._buf.truncate()
+        self._exp.write(self._sink, ep)
+        doc = self._buf.getvalue()
+        if not doc:
+            raise IOError("failed to serialize event parameters")
+
+        # split the document into header, children and footer
+        i = doc.index(b"<EventParameters")
+        j = doc.index(b">", i) + 1
+        if doc[j-2:j] == b"/>":
+            # no children
+            header, children, footer = doc[:j-2] + b">", b"", b"</EventParameters>" + doc[j:]
+        else:
+            k = doc.rindex(b"</EventParameters>")
+            header, children, footer = doc[:j], doc[j:k], doc[k:]
+
+        if self._footer is None:
+            self._write(header)
+            self._footer = footer
+        self._write(children)
+
+    def close(self):
+        if self._footer is None:
+            self.write(seiscomp.datamodel.EventParameters())
+        self._write(self._footer)
+        self._f.flush()
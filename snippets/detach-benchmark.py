@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Compares emptying an EventParameters instance from the front, as in
+# the old PickPlayer, with sc3stuff.util.detachChildren(), and checks
+# that the cast hack keeps the detached picks alive.
+#
+# Usage: detach-benchmark.py [max-number-of-picks]
+#
+# The picks are not registered, so there are no publicID conflicts.
+# Removing from the front is skipped beyond 100000 picks as it takes
+# too long.
+
+from __future__ import print_function
+import sys, time
+import seiscomp.core, seiscomp.datamodel
+import sc3stuff.util
+
+seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+
+def makeEventParameters(n):
+    ep = seiscomp.datamodel.EventParameters()
+    t = seiscomp.core.Time.GMT()
+    for i in range(n):
+        pick = seiscomp.datamodel.Pick("Pick/%d" % i)
+        pick.setTime(seiscomp.datamodel.TimeQuantity(t))
+        ep.add(pick)
+    return ep
+
+def removeFromFront(ep):
+    objs = []
+    while ep.pickCount() > 0:
+        # FIXME: The cast hack forces the SC3 refcounter to be increased.
+        pick = seiscomp.datamodel.Pick.Cast(ep.pick(0))
+        ep.removePick(0)
+        objs.append(pick)
+    return objs
+
+maxCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+n = 10000
+while n <= maxCount:
+    line = "%8d picks" % n
+    for label, extract in [ ("front", removeFromFront), ("detach", sc3stuff.util.detachChildren) ]:
+        if label == "front" and n > 100000:
+            line += "  %s %9s" % (label, "-")
+            continue
+        ep = makeEventParameters(n)
+        count = seiscomp.datamodel.PublicObject.ObjectCount()
+        t0 = time.time()
+        if extract is removeFromFront:
+            picks = extract(ep)
+        else:
+            picks = extract(ep, seiscomp.datamodel.Pick)
+        dt = time.time() - t0
+        line += "  %s %8.3fs" % (label, dt)
+
+        # The detached picks must still be alive and in their original
+        # order, and must be released together with the list.
+        assert ep.pickCount() == 0
+        assert seiscomp.datamodel.PublicObject.ObjectCount() == count
+        assert [ p.publicID() for p in picks[:3] ] == [ "Pick/0", "Pick/1", "Pick/2" ]
+        assert picks[-1].publicID() == "Pick/%d" % (n-1)
+        assert all(p.parent() is None for p in picks)
+        del picks
+        assert seiscomp.datamodel.PublicObject.ObjectCount() == count - n
+    print(line)
+    n *= 10
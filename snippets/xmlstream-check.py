@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Checks sc3stuff.xmlstream on picks and amplitudes. An amplitude
+# contains a nested <amplitude> element, its value, which must not end
+# the amplitude object. The input is fed in chunks of all sizes from 1
+# byte on, so that the elements are split at every possible position.
+#
+# Usage: xmlstream-check.py
+
+from __future__ import print_function
+import os, shutil, tempfile
+import seiscomp.core, seiscomp.datamodel
+import sc3stuff.xmlstream
+
+seiscomp.datamodel.PublicObject.SetRegistrationEnabled(False)
+
+root = b'<seiscomp xmlns="http://geofon.gfz-potsdam.de/ns/seiscomp3-schema/0.10" version="0.10">'
+
+def creationInfo(t):
+    return b"<creationInfo><creationTime>" + t + b"</creationTime></creationInfo>"
+
+def pick(publicID, t):
+    return (b'<pick publicID="' + publicID + b'"><time><value>' + t + b"</value></time>" +
+            b'<waveformID networkCode="XX" stationCode="ABC" locationCode="" channelCode="HHZ"/>' +
+            creationInfo(t) + b"</pick>")
+
+def amplitude(publicID, pickID, t):
+    return (b'<amplitude publicID="' + publicID + b'"><type>MLv</type>' +
+            b"<amplitude><value>1.0</value></amplitude><pickID>" + pickID + b"</pickID>" +
+            creationInfo(t) + b"</amplitude>")
+
+def document(*elements):
+    return (b'<?xml version="1.0" encoding="UTF-8"?>\n' + root + b"<EventParameters>" +
+            b"".join(elements) + b"</EventParameters></seiscomp>\n")
+
+doc = document(pick(b"P1", b"2020-01-01T00:00:01.0Z"),
+               amplitude(b"A1", b"P1", b"2020-01-01T00:00:01.0Z"),
+               pick(b"P2", b"2020-01-01T00:00:02.0Z"))
+
+# splitting
+for size in range(1, len(doc)+1):
+    splitter = sc3stuff.xmlstream.ElementSplitter()
+    elements = []
+    for i in range(0, len(doc), size):
+        elements.extend(splitter.feed(doc[i:i+size]))
+    splitter.close()
+    assert [ (name, publicID) for name, publicID, data in elements ] == \
+        [ ("pick", "P1"), ("amplitude", "A1"), ("pick", "P2") ], size
+    assert elements[1][2].endswith(b"</creationInfo></amplitude>"), elements[1][2]
+
+# parsing
+objs = sc3stuff.xmlstream.parseElements(splitter.root, elements)
+assert [ obj.publicID() for obj in objs ] == [ "P1", "A1", "P2" ]
+ampl = seiscomp.datamodel.Amplitude.Cast(objs[1])
+assert ampl.amplitude().value() == 1.0 and ampl.pickID() == "P1"
+
+# merging of files containing amplitudes
+tmp = tempfile.mkdtemp()
+try:
+    filenames = []
+    for name, data in [
+        ("a.xml", doc),
+        ("b.xml", document(pick(b"P3", b"2020-01-01T00:00:01.5Z"),
+                           amplitude(b"A3", b"P3", b"2020-01-01T00:00:01.5Z"),
+                           # duplicate from the other file
+                           amplitude(b"A1", b"P1", b"2020-01-01T00:00:01.0Z"))) ]:
+        filenames.append(os.path.join(tmp, name))
+        with open(filenames[-1], "wb") as f:
+            f.write(data)
+    merger = sc3stuff.xmlstream.mergeFiles(filenames)
+    merged = [ obj.publicID() for t, obj in merger ]
+    assert merged == [ "P1", "A1", "P3", "A3", "P2" ], merged
+    assert merger.duplicates == 1
+
+    # files outside the time window are not read at all
+    filenames.append(os.path.join(tmp, "c.xml"))
+    with open(filenames[-1], "wb") as f:
+        f.write(document(pick(b"P4", b"2020-01-02T00:00:00.0Z")))
+    read = []
+    readSorted = sc3stuff.xmlstream.readSorted
+    def recordingReadSorted(filename, *args):
+        read.append(os.path.basename(filename))
+        return readSorted(filename, *args)
+    sc3stuff.xmlstream.readSorted = recordingReadSorted
+    endTime = seiscomp.core.Time.GMT()
+    endTime.fromString("2020-01-01T12:00:00Z", "%FT%TZ")
+    merged = [ obj.publicID() for t, obj in sc3stuff.xmlstream.mergeFiles(filenames, None, endTime) ]
+    sc3stuff.xmlstream.readSorted = readSorted
+    assert merged == [ "P1", "A1", "P3", "A3", "P2" ], merged
+    assert sorted(read) == [ "a.xml", "b.xml" ], read
+finally:
+    shutil.rmtree(tmp)
+
+print("ok")